@@ -1,17 +1,20 @@
 import logging
 from fastapi import APIRouter, Path, HTTPException
 from fastapi.security import HTTPBearer
-from redis import Redis
-from fastapi import Depends, Header, Request
+from redis.asyncio import Redis
+from fastapi import Depends, Header, Request, Query
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer
-from app.db import get_db, get_redis
+from app.db import get_db, get_redis, SessionLocal
 from app.models import Party, ServiceProvider
 from app.responses import Response
 from app.identities import PartyInfo, ServiceProviderInfo
-from app import queue_manager
+from app import queue_manager, exports, profiling
 from app.responses import Response
 from app.utils import generate_code
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
 
 router = APIRouter(prefix="/admin")
 
@@ -19,43 +22,81 @@ router = APIRouter(prefix="/admin")
 Dev-facing
 """
 
+def provider_row(sp: ServiceProvider) -> dict:
+    return {
+        "id": sp.id,
+        "name": sp.name,
+        "email": sp.email,
+        "created_at": sp.created_at,
+    }
+
+def party_row(p: Party) -> dict:
+    return {
+        "phone": p.phone,
+        "name": p.name,
+        "size": p.size,
+        "priority": p.priority,
+        "created_at": p.created_at,
+        "last_login": p.last_login,
+    }
+
 @router.get("/providers", response_model=Response)
 async def list_service_providers(
-    db: Session = Depends(get_db)
+    after: Optional[int] = Query(None, description="Cursor: the last id of the previous page"),
+    limit: int = Query(100, ge=1, le=1000),
+    format: str = Query("json", pattern="^(json|ndjson|csv)$"),
+    db: AsyncSession = Depends(get_db)
 ):
+    if format != "json":
+        return StreamingResponse(
+            exports.stream_rows(SessionLocal, ServiceProvider, ServiceProvider.id, provider_row, after, format),
+            media_type=exports.MEDIA_TYPES[format],
+        )
     try:
-        providers = db.query(ServiceProvider).all()
-        provider_list = [
-            {
-                "id": sp.id,
-                "name": sp.name,
-                "email": sp.email,
-                "created_at": sp.created_at,
-            }
-            for sp in providers
-        ]
-        return Response(status_code=200, body={"service_providers": provider_list})
+        provider_list, next_cursor = await exports.fetch_page(db, ServiceProvider, ServiceProvider.id, provider_row, after, limit)
+        return Response(status_code=200, body={"service_providers": provider_list, "next_cursor": next_cursor})
     except Exception as e:
         return Response(status_code=500, body={"error": str(e)})
 
 @router.get("/parties", response_model=Response)
 async def list_parties(
-    db: Session = Depends(get_db)
+    after: Optional[str] = Query(None, description="Cursor: the last phone of the previous page"),
+    limit: int = Query(100, ge=1, le=1000),
+    format: str = Query("json", pattern="^(json|ndjson|csv)$"),
+    db: AsyncSession = Depends(get_db)
 ):
+    if format != "json":
+        return StreamingResponse(
+            exports.stream_rows(SessionLocal, Party, Party.phone, party_row, after, format),
+            media_type=exports.MEDIA_TYPES[format],
+        )
     try:
-        parties = db.query(Party).all()
-        party_list = [
-            {
-                "phone": p.phone,
-                "name": p.name,
-                "size": p.size,
-                "priority": p.priority,
-                "created_at": p.created_at,
-                "last_login": p.last_login,
-            }
-            for p in parties
-        ]
-        return Response(status_code=200, body={"parties": party_list})
+        party_list, next_cursor = await exports.fetch_page(db, Party, Party.phone, party_row, after, limit)
+        return Response(status_code=200, body={"parties": party_list, "next_cursor": next_cursor})
     except Exception as e:
         return Response(status_code=500, body={"error": str(e)})
-    
\ No newline at end of file
+
+
+"""Profiling endpoints hand out SQL text and timings, so they need the ADMIN_TOKEN even in development"""
+def require_admin(authorization: Optional[str] = Header(None)):
+    if not profiling.is_admin(authorization):
+        raise HTTPException(status_code=403, detail="Forbidden: Admin token required")
+
+@router.get("/profiles", response_model=Response, dependencies=[Depends(require_admin)])
+async def list_profiles():
+    # Newest first; each worker keeps its own buffer
+    profiles = [profiling.summary(record) for record in reversed(profiling.profiles)]
+    return Response(status_code=200, body={"sample_rate": profiling.sample_rate, "profiles": profiles})
+
+@router.get("/profiles/{profile_id}", response_model=Response, dependencies=[Depends(require_admin)])
+async def get_profile(profile_id: int):
+    record = profiling.find_profile(profile_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Profile not found, it may have been evicted")
+    return Response(status_code=200, body=profiling.details(record))
+
+@router.put("/profiles/sampling", response_model=Response, dependencies=[Depends(require_admin)])
+async def set_profile_sampling(rate: float = Query(..., ge=0, le=1)):
+    # Applies to the worker that serves this request only
+    profiling.set_sample_rate(rate)
+    return Response(status_code=200, body={"sample_rate": rate})
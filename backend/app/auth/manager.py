@@ -1,13 +1,19 @@
 import phonenumbers
 import logging
 import secrets
+import asyncio
+import hashlib
+import hmac
 import bcrypt
 import jwt
 import os
+import time
 from dotenv import load_dotenv
-from random import randint
-from redis import Redis
+from redis.asyncio import Redis
 from app.db import get_redis
+from app.cache import TTLCache
+from app.metrics import AUTH_CACHE, record_span
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from fastapi import Depends, Header, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
@@ -18,32 +24,69 @@ JWT_SECRET = os.getenv("JWT_SECRET", "super-secret-key")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_MINUTES = 30
 
-def store_otp(rdb: Redis, phone: str, otp: str, ttl: int = 300):
-    rdb.setex(f"otp:{phone}", ttl, hash_otp(otp))
+# Verified claims per worker, keyed by token hash and dropped at the token's exp
+REVOCATION_CHANNEL = "auth:revocations"
+verified_tokens = TTLCache(maxsize=int(os.getenv("TOKEN_CACHE_SIZE", 10000)))
+revoked_tokens = TTLCache(maxsize=int(os.getenv("TOKEN_CACHE_SIZE", 10000)))
 
-def get_otp(rdb: Redis, phone: str):
-    return rdb.get(f"otp:{phone}")
+# "hmac" stores short-lived OTPs as a keyed HMAC, "bcrypt" keeps the old salted hashes
+OTP_HASH_MODE = os.getenv("OTP_HASH_MODE", "hmac")
+OTP_SECRET = os.getenv("OTP_SECRET", JWT_SECRET)
 
-def delete_otp(rdb: Redis, phone: str):
-    rdb.delete(f"otp:{phone}")
+# bcrypt releases the GIL, so a small thread pool keeps it off the event loop
+bcrypt_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BCRYPT_WORKERS", min(4, os.cpu_count() or 1))),
+    thread_name_prefix="bcrypt",
+)
+
+async def run_bcrypt(fn, *args):
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(bcrypt_executor, fn, *args)
+    finally:
+        record_span("bcrypt", fn.__name__, start)
+
+async def store_otp(rdb: Redis, phone: str, otp: str, ttl: int = 300):
+    if OTP_HASH_MODE == "bcrypt":
+        hashed = await run_bcrypt(hash_otp, otp)
+    else:
+        hashed = hmac_otp(phone, otp)
+    await rdb.setex(f"otp:{phone}", ttl, hashed)
+
+async def get_otp(rdb: Redis, phone: str):
+    return await rdb.get(f"otp:{phone}")
+
+async def delete_otp(rdb: Redis, phone: str):
+    await rdb.delete(f"otp:{phone}")
 
 def generate_otp(length: int = 6) -> str:
     range_start = 10**(length-1)
     range_end = (10**length)-1
-    return str(randint(range_start, range_end))
+    # OTPs are the only secret in hmac mode, so draw them from a CSPRNG
+    return str(range_start + secrets.randbelow(range_end - range_start + 1))
 
 def hash_otp(otp: str) -> str:
     return bcrypt.hashpw(otp.encode(), bcrypt.gensalt()).decode()
 
-def verify_otp(submitted: str, hashed: str) -> bool:
-    return bcrypt.checkpw(submitted.encode(), hashed.encode())
+def hmac_otp(phone: str, otp: str) -> str:
+    # Bound to the phone so a stored digest cannot be replayed for another number
+    digest = hmac.new(OTP_SECRET.encode(), f"{phone}:{otp}".encode(), hashlib.sha256).hexdigest()
+    return f"hmac${digest}"
+
+async def verify_otp(phone: str, submitted: str, hashed: str) -> bool:
+    if hashed.startswith("hmac$"):
+        return hmac.compare_digest(hmac_otp(phone, submitted), hashed)
+    # OTPs stored with OTP_HASH_MODE=bcrypt
+    return await run_bcrypt(bcrypt.checkpw, submitted.encode(), hashed.encode())
 
 def send_sms(phone: str, otp: str):
     # Placeholder for SMS sending logic (e.g., Twilio)
-    print(f"Sending OTP {otp} to phone {phone}")
+    # Never log the OTP itself, anyone reading the logs could sign in as the phone's owner
+    logging.info(f"Sending OTP to phone {phone}")
 
 # ID can be phone number or service provider ID
-def create_tokens(id: str, rdb: Redis) -> str:
+async def create_tokens(id: str, rdb: Redis) -> str:
     expiration = datetime.now(timezone.utc) + timedelta(minutes=JWT_EXPIRATION_MINUTES)
     payload = {
         "sub": id,
@@ -52,23 +95,75 @@ def create_tokens(id: str, rdb: Redis) -> str:
     }
     access_token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
     refresh_token = secrets.token_urlsafe(32)
-    rdb.setex(f"refresh:{refresh_token}", timedelta(days=7), id)
-    rdb.setex(f"refresh_by_id:{id}", timedelta(days=7), refresh_token)
+    pipe = rdb.pipeline()
+    pipe.setex(f"refresh:{refresh_token}", timedelta(days=7), id)
+    pipe.setex(f"refresh_by_id:{id}", timedelta(days=7), refresh_token)
+    await pipe.execute()
     return [access_token, refresh_token]
 
-def verify_jwt(rdb: Redis, token: str) -> dict:
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+async def verify_jwt(rdb: Redis, token: str) -> dict:
+    key = token_hash(token)
+    if key in revoked_tokens:
+        AUTH_CACHE.labels("revoked").inc()
+        raise ValueError("Token has been revoked")
+    # Tokens already verified by this worker skip Redis and the decode
+    claims = verified_tokens.get(key)
+    if claims is not None:
+        AUTH_CACHE.labels("hit").inc()
+        return claims
+    AUTH_CACHE.labels("miss").inc()
+
     # Check if token is blacklisted
-    if rdb.get(f"blacklist:{token}"):
+    if await rdb.get(f"blacklist:{token}"):
         raise ValueError("Token has been revoked")
 
     # Decode and verify JWT
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload
     except jwt.ExpiredSignatureError:
         raise ValueError("Token expired")
     except jwt.InvalidTokenError:
         raise ValueError("Invalid token")
+    # A revocation may have landed while we were waiting on Redis
+    if key not in revoked_tokens:
+        verified_tokens.set(key, payload, payload["exp"])
+    return payload
+
+def forget_token(key: str, exp: float):
+    verified_tokens.pop(key)
+    revoked_tokens.set(key, True, exp)
+
+async def revoke_token(rdb: Redis, token: str, claims: dict):
+    # Blacklist for the rest of the token's lifetime and tell every worker to drop it
+    key = token_hash(token)
+    ttl = max(int(claims["exp"] - datetime.now(timezone.utc).timestamp()), 1)
+    forget_token(key, claims["exp"])
+    pipe = rdb.pipeline()
+    pipe.setex(f"blacklist:{token}", ttl, "revoked")
+    pipe.publish(REVOCATION_CHANNEL, f"{key}:{claims['exp']}")
+    await pipe.execute()
+
+async def listen_for_revocations(rdb: Redis):
+    while True:
+        try:
+            async with rdb.pubsub() as pubsub:
+                await pubsub.subscribe(REVOCATION_CHANNEL)
+                # Revocations published while we were disconnected are lost, start cold
+                verified_tokens.clear()
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    key, exp = message["data"].split(":", 1)
+                    forget_token(key, float(exp))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Revocation listener error: {e}")
+            verified_tokens.clear()
+            await asyncio.sleep(1)
 
 security = HTTPBearer()
 
@@ -77,15 +172,21 @@ def get_auth_header(authorization: str = Header(..., alias="Authorization")) ->
         raise HTTPException(status_code=401, detail="Invalid token format")
     return authorization.replace("Bearer ", "").strip()
 
-def get_token(
+"""Dependency returning the verified claims, resolved once per request"""
+async def get_claims(
     token: str = Depends(get_auth_header),
     rdb: Redis = Depends(get_redis)
-) -> str:
+) -> dict:
     try:
         # This will check blacklist, expiration, and validity
-        verify_jwt(rdb, token)
+        return await verify_jwt(rdb, token)
     except ValueError as e:
         raise HTTPException(status_code=401, detail=str(e))
+
+async def get_token(
+    token: str = Depends(get_auth_header),
+    claims: dict = Depends(get_claims)
+) -> str:
     return token
 
 def parse_token(token: str) -> dict:
@@ -96,8 +197,9 @@ def parse_token(token: str) -> dict:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+async def hash_password(password: str) -> str:
+    hashed = await run_bcrypt(bcrypt.hashpw, password.encode(), bcrypt.gensalt())
+    return hashed.decode()
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await run_bcrypt(bcrypt.checkpw, plain_password.encode(), hashed_password.encode())
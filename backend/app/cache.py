@@ -0,0 +1,42 @@
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+"""
+Bounded per-worker LRU whose entries expire at an absolute unix timestamp.
+Not shared between workers, so anything cached here needs its own
+invalidation path (see the pub/sub listeners started in main.py).
+"""
+class TTLCache:
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at <= time.time():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, expires_at: float):
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: str):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,32 @@
+import orjson
+from starlette.responses import Response
+
+"""
+JSON encoding for the hot paths, backed by orjson.
+
+`dumps` and `loads` stand in for the json module on values kept in Redis
+and pushed to event streams. The format is the same, so the Lua scripts
+(cjson) and data written before read the same, but encoding and decoding
+are several times faster and non-ASCII text is stored as UTF-8 instead of
+\\u escapes. `dumps` returns bytes, which redis-py stores as they are; use
+`dumps_str` where text is needed.
+
+Hot routes return an ORJSONResponse built from plain dicts. FastAPI hands
+Response instances to the client untouched, so the payload isn't
+validated and serialized a second time against `response_model`, which
+stays on the route for the OpenAPI schema.
+"""
+
+loads = orjson.loads
+
+def dumps(value) -> bytes:
+    return orjson.dumps(value)
+
+def dumps_str(value) -> str:
+    return orjson.dumps(value).decode()
+
+class ORJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
@@ -1,46 +1,80 @@
 import os, logging
-from redis import Redis
+from fastapi.requests import HTTPConnection
+from redis.asyncio import Redis, RedisCluster, BlockingConnectionPool
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from app.logs import configure_logging
+from app.metrics import InstrumentedConnection, instrument_engine
 
-logging.basicConfig(
-    level=logging.DEBUG,  # Or INFO for less verbosity
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
+# LOG_LEVEL, written from a background thread, see app/logs.py
+configure_logging()
 
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# Size of both asyncpg's and SQLAlchemy's prepared statement caches, 0 disables them (e.g. behind pgbouncer)
+pg_statement_cache_size = int(os.getenv('PG_STATEMENT_CACHE_SIZE', 100))
+
 pg_conn_string = \
-    (f'postgresql+psycopg2://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}'
-     f'@{os.getenv('POSTGRES_HOST')}:{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB')}')
+    (f'postgresql+asyncpg://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}'
+     f'@{os.getenv('POSTGRES_HOST')}:{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB')}'
+     f'?prepared_statement_cache_size={pg_statement_cache_size}')
 
 redis_conn_string = \
     f'redis://{os.getenv('REDIS_HOST')}:{os.getenv('REDIS_PORT')}'
 
-engine = create_engine(pg_conn_string, echo=True)
+engine = create_async_engine(
+    pg_conn_string,
+    echo=os.getenv('SQL_ECHO', 'false').lower() == 'true',
+    pool_size=int(os.getenv('PG_POOL_SIZE', 10)),
+    max_overflow=int(os.getenv('PG_MAX_OVERFLOW', 20)),
+    pool_timeout=float(os.getenv('PG_POOL_TIMEOUT', 30)),
+    pool_recycle=int(os.getenv('PG_POOL_RECYCLE', 1800)),
+    pool_pre_ping=os.getenv('PG_POOL_PRE_PING', 'true').lower() == 'true',
+    connect_args={"statement_cache_size": pg_statement_cache_size},
+)
+instrument_engine(engine)
 
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 """Dependency to get Postgres DB session"""
-def get_db():
-    db = SessionLocal()
-    try:
-        logging.info("Connected to PostgreSQL")
-        yield db
-    except BaseException as e:
-        logging.error(f"DB session error: {e}")
-        raise e
-    finally:
-        db.close()
+async def get_db():
+    async with SessionLocal() as db:
+        try:
+            yield db
+        except BaseException as e:
+            logging.error(f"DB session error: {e}")
+            raise e
+
+# With REDIS_CLUSTER=true REDIS_HOST/REDIS_PORT name any cluster node, the rest are discovered
+redis_cluster = os.getenv('REDIS_CLUSTER', 'false').lower() in ('1', 'true', 'yes')
+
+"""Creates the app-wide Redis connection pool, see the lifespan hook in main.py"""
+def create_redis_pool() -> BlockingConnectionPool:
+    return BlockingConnectionPool.from_url(
+        redis_conn_string,
+        db=0,
+        decode_responses=True,
+        connection_class=InstrumentedConnection,
+        max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', 512)),
+        timeout=float(os.getenv('REDIS_POOL_TIMEOUT', 5)),
+    )
+
+"""Creates the app-wide Redis client, a cluster client when REDIS_CLUSTER is set"""
+def create_redis() -> Redis:
+    if redis_cluster:
+        return RedisCluster.from_url(
+            redis_conn_string,
+            decode_responses=True,
+            max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', 512)),
+        )
+    return Redis.from_pool(create_redis_pool())
 
 """Dependency to get Redis client"""
-def get_redis():
-    rdb = Redis(host=os.getenv('REDIS_HOST'), port=os.getenv('REDIS_PORT'), db=0, decode_responses=True)
+async def get_redis(conn: HTTPConnection):
+    rdb = conn.app.state.redis
     try:
-        logging.info("Connected to Redis")
         yield rdb
     except BaseException as e:
         logging.error(f"Redis connection error: {e}")
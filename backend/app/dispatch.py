@@ -0,0 +1,212 @@
+import uuid
+from typing import Optional
+from datetime import datetime, timezone
+from redis.asyncio import Redis
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.codec import loads
+from app.models import Block, Party
+from app.placement import BUCKET_CEILING
+from app.event_log import append_event
+from app.estimator import ETA_ALPHA
+from app.keys import PREFIX_LUA, blocks_key, parties_key, status_key, outbox_key, eta_key, instance_key
+from app.queue_manager import decode_party
+
+"""
+Dispatch engine.
+
+Dispatching pops the head block off the queue's blocks list, marks it
+dispatched and drops its parties from the queue in one Lua script. The same
+script appends the block to the queue's `dispatched` outbox, and the outbox is then
+flushed into Postgres with bulk upserts. An entry leaves the outbox only
+after its transaction commits, so a crash between the two steps is retried
+on the next dispatch and the upserts make the retry harmless: a block is
+never lost and never dispatched twice.
+
+A dispatch request flushes at most one batch (PERSIST_BATCH entries) on
+its way out. Otherwise the request holding the flush lock under a burst of
+dispatches would keep draining the entries every other request appends.
+Anything left is written by the next dispatch; deleting a queue flushes all
+of it.
+
+Block rows are keyed by block id plus the queue's instance id (set when the
+queue is created), since a deleted queue's code can be handed out again and
+its new blocks would otherwise overwrite the old queue's history. Blocks of
+queues created before instance ids keep their plain block id.
+"""
+
+PERSIST_BATCH = 100  # outbox entries written per transaction
+PERSIST_LOCK_SECONDS = 30
+
+"""Releases the flush lock only if it still holds our token, not one taken after ours expired"""
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+DISPATCH_BLOCK_LUA = PREFIX_LUA + """
+local blocks_key = KEYS[1]
+local parties_key = KEYS[2]
+local status_key = KEYS[3]
+local outbox_key = KEYS[4]
+local eta_key = KEYS[5]
+local instance_key = KEYS[6]
+local code = ARGV[1]
+local ceiling = tonumber(ARGV[2])
+local alpha = tonumber(ARGV[3])
+
+local seq = redis.call('LPOP', blocks_key)
+if not seq then
+    return nil
+end
+
+local key = prefix .. 'block:' .. seq
+local state = redis.call('HMGET', key, 'capacity', 'used', 'created_at', 'reserved', 'reserved_used')
+local capacity, used = tonumber(state[1]), tonumber(state[2])
+local reserved, reserved_used = tonumber(state[4]) or 0, tonumber(state[5]) or 0
+local now = tonumber(redis.call('TIME')[1])
+if capacity >= 0 then
+    local open_left = capacity - reserved - (used - reserved_used)
+    if open_left > 0 then
+        redis.call('ZREM', prefix .. 'open:' .. math.min(open_left, ceiling), seq)
+    end
+    if reserved - reserved_used > 0 then
+        redis.call('ZREM', prefix .. 'priority:' .. math.min(reserved - reserved_used, ceiling), seq)
+    end
+end
+
+local roster = redis.call('HGETALL', key .. ':parties')
+for i = 1, #roster, 2 do
+    redis.call('HDEL', parties_key, roster[i])
+end
+redis.call('DEL', key, key .. ':parties', key .. ':reserved')
+
+-- Wait-time EWMAs. The interval runs from the later of the previous dispatch
+-- and this block's creation, so idle stretches with an empty queue don't count.
+local created = tonumber(state[3]) or now
+local eta = redis.call('HMGET', eta_key, 'interval', 'service', 'last_dispatch')
+local function ewma(prev, sample)
+    prev = tonumber(prev)
+    if not prev then
+        return sample
+    end
+    return alpha * sample + (1 - alpha) * prev
+end
+redis.call('HSET', eta_key,
+    'interval', tostring(ewma(eta[1], now - math.max(tonumber(eta[3]) or created, created))),
+    'service', tostring(ewma(eta[2], now - created)),
+    'last_dispatch', now)
+
+redis.call('HINCRBY', status_key, 'size', -used)
+redis.call('HINCRBY', status_key, 'parties', -(#roster / 2))
+redis.call('HINCRBY', status_key, 'block_count', -1)
+local next_seq = redis.call('LINDEX', blocks_key, 0)
+if next_seq then
+    redis.call('HSET', status_key, 'serving_block', next_seq)
+else
+    redis.call('HDEL', status_key, 'serving_block')
+end
+
+local block = cjson.encode({
+    block_id = code .. '-' .. seq,
+    capacity = capacity,
+    used = used,
+    created_at = tonumber(state[3]),
+    dispatched_at = now,
+    roster = roster,
+    instance = redis.call('GET', instance_key) or nil,
+})
+redis.call('RPUSH', outbox_key, block)
+redis.call('PUBLISH', 'queue:' .. code .. ':events', cjson.encode({
+    type = 'dispatch',
+    block_id = code .. '-' .. seq,
+    party_size = used,
+    queue_size = tonumber(redis.call('HGET', status_key, 'size')),
+    serving_block = tonumber(next_seq),
+}))
+return block
+"""
+
+def to_datetime(ts) -> datetime:
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None) if ts else None
+
+async def dispatch_block(rdb: Redis, code: str):
+    script = rdb.register_script(DISPATCH_BLOCK_LUA)
+    keys = [blocks_key(code), parties_key(code), status_key(code), outbox_key(code), eta_key(code), instance_key(code)]
+    raw = await script(keys=keys, args=[code, BUCKET_CEILING, ETA_ALPHA])
+    if not raw:
+        return None
+    block = loads(raw)
+    await append_event(rdb, "dispatch", code, block_id=block["block_id"], party_size=block["used"])
+    return block
+
+async def persist_dispatched(rdb: Redis, db: AsyncSession, code: str, service_provider_id: int,
+                             max_batches: Optional[int] = None) -> int:
+    """Writes up to max_batches batches of the outbox to Postgres, all of it by default"""
+    outbox = outbox_key(code)
+    lock_key = f"{outbox}:lock"
+    # One flusher per queue, otherwise two of them could trim each other's entries
+    token = uuid.uuid4().hex
+    if not await rdb.set(lock_key, token, nx=True, ex=PERSIST_LOCK_SECONDS):
+        return 0
+    try:
+        return await flush_outbox(rdb, db, code, service_provider_id, outbox, max_batches)
+    finally:
+        await rdb.register_script(RELEASE_LOCK_LUA)(keys=[lock_key], args=[token])
+
+def block_row_id(block: dict) -> str:
+    # A reused code starts again at block 1, the instance keeps its rows apart from the old queue's
+    instance = block.get("instance")
+    return f"{block['block_id']}.{instance}" if instance else block["block_id"]
+
+async def flush_outbox(rdb: Redis, db: AsyncSession, code: str, service_provider_id: int, outbox: str,
+                       max_batches: Optional[int] = None) -> int:
+    persisted, batches = 0, 0
+    while max_batches is None or batches < max_batches:
+        batches += 1
+        entries = await rdb.lrange(outbox, 0, PERSIST_BATCH - 1)
+        if not entries:
+            return persisted
+        block_rows, party_rows = [], {}
+        for entry in entries:
+            block = loads(entry)
+            row_id = block_row_id(block)
+            block_rows.append({
+                "id": row_id,
+                "capacity": block["capacity"],
+                "status": "dispatched",
+                "created_at": to_datetime(block.get("created_at")),
+                "dispatched_at": to_datetime(block["dispatched_at"]),
+                "service_provider_id": service_provider_id,
+                "queue_code": code,
+            })
+            roster = block["roster"]
+            for i in range(0, len(roster), 2):
+                party = decode_party(roster[i], roster[i + 1])
+                # A phone can rejoin after being dispatched, keep its latest block
+                party_rows[party.phone] = {
+                    "phone": party.phone,
+                    "name": party.name,
+                    "size": party.party_size,
+                    "priority": party.priority,
+                    "block_id": row_id,
+                }
+
+        stmt = insert(Block).values(block_rows)
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[Block.id],
+            set_={"status": stmt.excluded.status, "dispatched_at": stmt.excluded.dispatched_at},
+        ))
+        if party_rows:
+            stmt = insert(Party).values(list(party_rows.values()))
+            await db.execute(stmt.on_conflict_do_update(
+                index_elements=[Party.phone],
+                set_={"block_id": stmt.excluded.block_id, "size": stmt.excluded.size},
+            ))
+        await db.commit()
+        # Only drop what was committed; new dispatches may have been appended meanwhile
+        await rdb.ltrim(outbox, len(entries), -1)
+        persisted += len(entries)
+    return persisted
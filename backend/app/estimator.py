@@ -0,0 +1,36 @@
+import os
+import time
+from typing import Optional
+
+"""
+Wait-time estimator.
+
+DISPATCH_BLOCK_LUA folds every dispatch into exponentially weighted moving
+averages kept in the queue's `eta` hash (app/keys.py):
+
+    interval       seconds between dispatches while the queue had a block ready
+    service        seconds a block spent in the queue, created_at to dispatch
+    last_dispatch  unix time of the latest dispatch
+
+Blocks are numbered consecutively and dispatched from the head, so a party
+in block `seq` has `seq - serving_block` blocks ahead of it and its ETA is
+arithmetic on a single HGETALL, no history needed.
+"""
+
+ETA_ALPHA = float(os.getenv("ETA_ALPHA", 0.3))  # weight of the newest sample
+
+def block_eta(eta: dict, position: int, now: Optional[float] = None) -> Optional[int]:
+    """Seconds until the block `position` places behind the head is dispatched"""
+    interval = float(eta.get("interval") or 0)
+    if not interval:
+        # No backlogged dispatch measured yet, best guess is how long blocks have waited
+        service = eta.get("service")
+        return int(float(service)) if service else None
+    now = time.time() if now is None else now
+    elapsed = now - float(eta.get("last_dispatch") or now)
+    return int(max(interval - elapsed, 0) + position * interval)
+
+def format_wait(seconds: Optional[int]) -> Optional[str]:
+    if seconds is None:
+        return None
+    return f"{round(seconds / 60)} min"
@@ -0,0 +1,170 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+from datetime import datetime, timezone
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import ResponseError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.models import QueueEvent
+
+"""
+Write-behind event log.
+
+Every join, leave and dispatch is XADDed to the `queue_events` stream right
+after the queue script that made the change, so the request path never
+waits on Postgres. The stream is one key shared by all queues, which is why
+the scripts (whose keys must share a cluster slot) don't write it
+themselves. A consumer group worker running in every API
+worker reads the stream in batches and writes them to the queue_events
+table with one multi-row INSERT per batch. Entries are XACKed only after
+the transaction commits (at-least-once) and the stream id is the primary
+key, so redelivered entries are dropped by ON CONFLICT DO NOTHING.
+
+Backpressure: each worker has at most one batch in flight and only reads
+the next one after the previous commit, so a slow Postgres makes the
+stream grow (capped at EVENT_STREAM_MAXLEN) instead of piling up
+concurrent writes. Failed batches stay pending and are retried with
+exponential backoff; entries left pending by a crashed worker are claimed
+by the others after EVENT_CLAIM_IDLE_MS.
+
+Every retry or claim counts as a delivery. Entries delivered more than
+EVENT_MAX_DELIVERIES times are moved to the `queue_events:dead` stream
+(with their original id in `entry_id`) and acknowledged, so an entry
+Postgres keeps rejecting can't hold back the backlog behind it. The rest of
+its batch goes with it, as does a batch that outlasts a long Postgres
+outage; dead entries are kept for inspection and can be XADDed back to
+replay them.
+"""
+
+EVENT_STREAM = "queue_events"
+EVENT_DEAD_LETTER_STREAM = "queue_events:dead"
+EVENT_STREAM_MAXLEN = int(os.getenv("EVENT_STREAM_MAXLEN", 1000000))
+EVENT_GROUP = "queue_events_writer"
+EVENT_BATCH = int(os.getenv("EVENT_BATCH", 500))
+EVENT_BLOCK_MS = 5000
+EVENT_CLAIM_IDLE_MS = int(os.getenv("EVENT_CLAIM_IDLE_MS", 60000))
+EVENT_MAX_DELIVERIES = int(os.getenv("EVENT_MAX_DELIVERIES", 20))  # about 8 minutes of retries at MAX_BACKOFF_SECONDS
+MAX_BACKOFF_SECONDS = 30
+
+async def append_event(rdb: Redis, event_type: str, code: str, **fields):
+    await append_events(rdb, [{"type": event_type, "code": code, **fields}])
+
+async def append_events(rdb: Redis, events: list[dict]):
+    if not events:
+        return
+    pipe = rdb.pipeline(transaction=False)
+    for event in events:
+        add_event(pipe, event)
+    await pipe.execute()
+
+def add_event(pipe: Pipeline, event: dict):
+    # For callers that append the event to a pipeline they already send
+    pipe.xadd(EVENT_STREAM, {k: v for k, v in event.items() if v is not None},
+              maxlen=EVENT_STREAM_MAXLEN, approximate=True)
+
+def event_row(entry_id: str, fields: dict) -> dict:
+    millis = int(entry_id.split("-", 1)[0])
+    party_size = fields.get("party_size")
+    return {
+        "id": entry_id,
+        "type": fields.get("type", "unknown"),
+        "queue_code": fields.get("code"),
+        "phone": fields.get("phone"),
+        "block_id": fields.get("block_id"),
+        "party_size": int(party_size) if party_size else None,
+        "created_at": datetime.fromtimestamp(millis / 1000, timezone.utc).replace(tzinfo=None),
+    }
+
+async def write_events(session_factory: async_sessionmaker, entries: list) -> None:
+    rows = [event_row(entry_id, fields) for entry_id, fields in entries]
+    async with session_factory() as db:
+        await db.execute(insert(QueueEvent).values(rows).on_conflict_do_nothing(index_elements=[QueueEvent.id]))
+        await db.commit()
+
+async def ensure_group(rdb: Redis):
+    try:
+        await rdb.xgroup_create(EVENT_STREAM, EVENT_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+async def dead_letter(rdb: Redis, entries: list):
+    pipe = rdb.pipeline(transaction=False)
+    for entry_id, fields in entries:
+        if fields:
+            pipe.xadd(EVENT_DEAD_LETTER_STREAM, {**fields, "entry_id": entry_id},
+                      maxlen=EVENT_STREAM_MAXLEN, approximate=True)
+    pipe.xack(EVENT_STREAM, EVENT_GROUP, *[entry_id for entry_id, _ in entries])
+    await pipe.execute()
+    logging.error(f"Moved {len(entries)} events to {EVENT_DEAD_LETTER_STREAM} after "
+                  f"{EVENT_MAX_DELIVERIES} deliveries: {[entry_id for entry_id, _ in entries]}")
+
+async def drop_exhausted(rdb: Redis, consumer: str, entries: list) -> list:
+    """Dead-letters the entries delivered more than EVENT_MAX_DELIVERIES times and returns the rest"""
+    pending = await rdb.xpending_range(EVENT_STREAM, EVENT_GROUP, min=entries[0][0], max=entries[-1][0],
+                                       count=len(entries), consumername=consumer)
+    exhausted = {p["message_id"] for p in pending if p["times_delivered"] > EVENT_MAX_DELIVERIES}
+    if not exhausted:
+        return entries
+    await dead_letter(rdb, [entry for entry in entries if entry[0] in exhausted])
+    return [entry for entry in entries if entry[0] not in exhausted]
+
+async def read_backlog(rdb: Redis, consumer: str) -> list:
+    # Our own unacknowledged entries first, then ones abandoned by dead workers
+    while True:
+        response = await rdb.xreadgroup(EVENT_GROUP, consumer, {EVENT_STREAM: "0"}, count=EVENT_BATCH)
+        entries = response[0][1] if response else []
+        if not entries:
+            claimed = await rdb.xautoclaim(EVENT_STREAM, EVENT_GROUP, consumer,
+                                           min_idle_time=EVENT_CLAIM_IDLE_MS, count=EVENT_BATCH)
+            entries = claimed[1]
+        if not entries:
+            return entries
+        # Only backlog entries can have been delivered before; a batch dead-lettered whole is acked, read on
+        entries = await drop_exhausted(rdb, consumer, entries)
+        if entries:
+            return entries
+
+async def read_new(rdb: Redis, consumer: str) -> list:
+    response = await rdb.xreadgroup(EVENT_GROUP, consumer, {EVENT_STREAM: ">"},
+                                    count=EVENT_BATCH, block=EVENT_BLOCK_MS)
+    return response[0][1] if response else []
+
+async def run_event_writer(rdb: Redis, session_factory: async_sessionmaker):
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    backoff = 0
+    backlog = True
+    next_claim = 0.0
+    await_group = True
+    while True:
+        try:
+            if await_group:
+                await ensure_group(rdb)
+                await_group = False
+            if backlog or time.monotonic() >= next_claim:
+                entries = await read_backlog(rdb, consumer)
+                if not entries:
+                    backlog = False
+                    next_claim = time.monotonic() + EVENT_CLAIM_IDLE_MS / 1000
+                    continue
+            else:
+                entries = await read_new(rdb, consumer)
+            if entries:
+                # Entries trimmed by MAXLEN while pending come back without fields
+                rows = [(entry_id, fields) for entry_id, fields in entries if fields]
+                if rows:
+                    await write_events(session_factory, rows)
+                await rdb.xack(EVENT_STREAM, EVENT_GROUP, *[entry_id for entry_id, _ in entries])
+            backoff = 0
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            backoff = min(max(backoff * 2, 1), MAX_BACKOFF_SECONDS)
+            logging.error(f"Event writer error, retrying in {backoff}s: {e}")
+            backlog = True
+            await_group = True
+            await asyncio.sleep(backoff)
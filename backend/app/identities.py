@@ -1,11 +1,11 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from typing import Optional
 from pydantic_redis import Model
 
 class PartyInfo(BaseModel):
     phone: str
     name: str
-    party_size: int = 1
+    party_size: int = Field(1, ge=1)
     priority: int = 0  # e.g. 0 = normal, 1 = VIP
     otp: Optional[str] = None  # for auth purposes
 
@@ -0,0 +1,98 @@
+"""
+Redis key schema.
+
+Every key belonging to a queue starts with `queue:{CODE}:`. The braces are
+a Redis Cluster hash tag, so only CODE is hashed and all of a queue's keys
+land in the same slot: the Lua scripts and MULTI pipelines that touch
+several of them keep working once the keyspace is sharded. Scripts get the
+prefix from their first key (see `PREFIX_LUA`) and build per-block keys
+from it.
+
+Keys that span queues (the provider index, the event stream, auth keys)
+live outside the per-queue tag; anything that must be updated together with
+queue keys is written in a separate, non-transactional step.
+"""
+
+def queue_prefix(code: str) -> str:
+    return f"queue:{{{code}}}:"
+
+def queue_key(code: str) -> str:
+    # QueueInfo, a hash of JSON-encoded fields (app/queue_info.py)
+    return f"queue:{{{code}}}"
+
+def legacy_queue_key(code: str) -> str:
+    # QueueInfo of a queue still in the untagged layout, see app/migrations.py
+    return f"queue:{code}"
+
+def blocks_key(code: str) -> str:
+    return f"{queue_prefix(code)}blocks"
+
+def block_key(code: str, seq) -> str:
+    return f"{queue_prefix(code)}block:{seq}"
+
+def block_parties_key(code: str, seq) -> str:
+    return f"{block_key(code, seq)}:parties"
+
+def block_reserved_key(code: str, seq) -> str:
+    return f"{block_key(code, seq)}:reserved"
+
+def block_counter_key(code: str) -> str:
+    return f"{queue_prefix(code)}block_counter"
+
+def block_capacity_key(code: str) -> str:
+    return f"{queue_prefix(code)}block_capacity"
+
+def priority_slots_key(code: str) -> str:
+    return f"{queue_prefix(code)}priority_slots"
+
+def packing_key(code: str) -> str:
+    return f"{queue_prefix(code)}packing"
+
+def service_provider_key(code: str) -> str:
+    # The queue's owner, also the key that claims the code (see allocate_code)
+    return f"{queue_prefix(code)}service_provider_id"
+
+def parties_key(code: str) -> str:
+    return f"{queue_prefix(code)}parties"
+
+def status_key(code: str) -> str:
+    return f"{queue_prefix(code)}status"
+
+def bucket_key(code: str, tier: str, remaining: int) -> str:
+    return f"{queue_prefix(code)}{tier}:{remaining}"
+
+def eta_key(code: str) -> str:
+    return f"{queue_prefix(code)}eta"
+
+def instance_key(code: str) -> str:
+    # Random id of this incarnation of the code, which is reused once a queue is deleted
+    return f"{queue_prefix(code)}instance"
+
+def outbox_key(code: str) -> str:
+    return f"{queue_prefix(code)}dispatched"
+
+def events_channel(code: str) -> str:
+    # Pub/sub channels are not hashed to slots, so this one keeps its plain name
+    return f"queue:{code}:events"
+
+def rate_limit_key(rule: str, scope: str, identity: str) -> str:
+    # Tagged by rule, so one script can check all of a request's buckets in cluster mode too
+    return f"ratelimit:{{{rule}}}:{scope}:{identity}"
+
+"""Lua preamble giving scripts the hash-tagged prefix of the queue named by KEYS[1]"""
+PREFIX_LUA = """
+local prefix = string.match(KEYS[1], '^(queue:{[^}]*}:)')
+"""
+
+"""Per-queue key suffixes, used by the migration from the untagged layout"""
+QUEUE_SUFFIXES = (
+    "block_counter",
+    "block_capacity",
+    "priority_slots",
+    "packing",
+    "service_provider_id",
+    "parties",
+    "status",
+    "eta",
+    "dispatched",
+)
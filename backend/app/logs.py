@@ -0,0 +1,48 @@
+import os
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+"""
+Non-blocking logging.
+
+Handlers that write to a stream or a log shipper can block, so the root
+logger only puts records on a bounded in-memory queue and a QueueListener
+thread formats and writes them. When the writer falls behind by more than
+LOG_QUEUE_SIZE records new ones are dropped (and counted) rather than
+stalling the event loop. Per-request lines are sampled, see
+app/metrics.py.
+"""
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def configure_logging():
+    root = logging.getLogger()
+    if any(isinstance(handler, DroppingQueueHandler) for handler in root.handlers):
+        return
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(log_queue, stream, respect_handler_level=True)
+    root.handlers = [DroppingQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    # Flush what is still queued on exit
+    atexit.register(listener.stop)
+
+def dropped_records() -> int:
+    return sum(getattr(handler, "dropped", 0) for handler in logging.getLogger().handlers)
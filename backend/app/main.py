@@ -1,20 +1,33 @@
+import os
+import asyncio
+import secrets
 import logging
+import contextlib
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from fastapi import Path, Depends, HTTPException
+from fastapi import Path, Depends, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from prometheus_client import CONTENT_TYPE_LATEST
 from fastapi.middleware.cors import CORSMiddleware
-from redis import Redis
-from sqlalchemy.orm import Session
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.responses import Response, JoinQueueResponse, QueueStatusResponse
 from app.queues import QueueInfo, BlockInfo
 from app.identities import PartyInfo, ServiceProviderInfo
 from app.utils import generate_code
 import app.queue_manager as queue_manager
 from app.auth.manager import generate_otp, store_otp, get_otp, verify_otp, delete_otp
-from app.auth.manager import send_sms, create_tokens, get_token
+from app.auth.manager import send_sms, create_tokens, get_token, listen_for_revocations
 from app.models import ServiceProvider, Party
 from datetime import timedelta, datetime
 
-from app.db import get_db, get_redis
+from app.db import get_db, get_redis, create_redis, engine, SessionLocal
+from app.event_log import run_event_writer
+from app.notifier import QueueNotifier
+from app.queue_cache import listen_for_queue_invalidations
+from app.metrics import MetricsMiddleware, render
+from app.profiling import ProfilingMiddleware
+from app.codec import ORJSONResponse
 from app.models import Party
 
 from app.auth.routes import router as auth_router
@@ -22,7 +35,26 @@ from app.user.routes import router as user_router
 from app.admin.routes import router as admin_router
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One Redis client (and connection pool) per worker, shared by every request
+    rdb = app.state.redis = create_redis()
+    revocations = asyncio.create_task(listen_for_revocations(rdb))
+    invalidations = asyncio.create_task(listen_for_queue_invalidations(rdb))
+    app.state.notifier = QueueNotifier(rdb)
+    event_writer = asyncio.create_task(run_event_writer(rdb, SessionLocal))
+    yield
+    event_writer.cancel()
+    # Let an in-flight batch roll back before the engine is disposed
+    with contextlib.suppress(asyncio.CancelledError):
+        await event_writer
+    await app.state.notifier.close()
+    revocations.cancel()
+    invalidations.cancel()
+    await rdb.aclose()
+    await engine.dispose()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 logging.info("✅ FastAPI app loaded")
 
@@ -35,6 +67,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Attaches spans to the RequestStats MetricsMiddleware sets up around it
+app.add_middleware(ProfilingMiddleware)
+
+# Outermost, so the latency it records includes the other middleware
+app.add_middleware(MetricsMiddleware)
+
 app.include_router(auth_router)
 app.include_router(user_router)
 app.include_router(admin_router)
@@ -43,3 +81,13 @@ app.include_router(admin_router)
 async def root():
     return Response(status_code=200, body={ "message": "Welcome to the Queue Management API" })
 
+# Unset disables /metrics, scrapers send it as a bearer token
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request, rdb: Redis = Depends(get_redis)):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(await render(rdb, engine), media_type=CONTENT_TYPE_LATEST)
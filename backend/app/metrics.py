@@ -0,0 +1,230 @@
+import os
+import time
+import random
+import logging
+from contextvars import ContextVar
+from typing import Optional
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from redis.asyncio import Redis
+from redis.asyncio.connection import Connection
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from app.logs import dropped_records
+
+"""
+Prometheus metrics, served at /metrics to scrapers that send METRICS_TOKEN
+as a bearer token; without METRICS_TOKEN the endpoint is disabled.
+
+MetricsMiddleware times every HTTP request by route template and counts
+the Redis commands, Redis round trips and SQL queries it issued. Redis is
+counted by the connection class the pool is built with (a pipeline or a
+script is one round trip however many commands it carries), SQL by engine
+events. Both attribute work to the request through a context variable.
+
+Queue gauges and connection pool gauges are read when /metrics is scraped:
+queue counters come straight from each queue's `status` hash, so every
+worker reports the same values; take max() rather than sum() over workers.
+They are totals over the first METRICS_MAX_QUEUES queues found, plus a
+`queues` count. Queue codes are what parties join with, so per-queue series
+labelled with the code are only exported with METRICS_PER_QUEUE=true.
+Under `uvicorn --workers N` set PROMETHEUS_MULTIPROC_DIR so the request
+metrics of all workers are merged into each scrape.
+
+Access log lines are sampled (ACCESS_LOG_SAMPLE_RATE), except for server
+errors and requests slower than SLOW_REQUEST_SECONDS which are always logged.
+"""
+
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("ACCESS_LOG_SAMPLE_RATE", 0.01))
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 1))
+METRICS_MAX_QUEUES = int(os.getenv("METRICS_MAX_QUEUES", 1000))  # queues with gauges, scanned per scrape
+METRICS_PER_QUEUE = os.getenv("METRICS_PER_QUEUE", "false").lower() in ("1", "true", "yes")
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+SQL_SPAN_CHARS = 300  # statement text kept per SQL span of a profiled request
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, float("inf"))
+
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"])
+IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being served", multiprocess_mode="livesum")
+REDIS_COMMANDS = Counter("redis_commands", "Redis commands sent", ["command"])
+REDIS_ROUND_TRIPS = Counter("redis_round_trips", "Writes to a Redis connection, one per command or pipeline")
+REDIS_PER_REQUEST = Histogram("redis_commands_per_request", "Redis commands per HTTP request", buckets=COUNT_BUCKETS)
+REDIS_ROUND_TRIPS_PER_REQUEST = Histogram("redis_round_trips_per_request", "Redis round trips per HTTP request",
+                                          buckets=COUNT_BUCKETS)
+SQL_LATENCY = Histogram("sql_query_duration_seconds", "SQL statement latency",
+                        buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, float("inf")))
+SQL_PER_REQUEST = Histogram("sql_queries_per_request", "SQL statements per HTTP request", buckets=COUNT_BUCKETS)
+AUTH_CACHE = Counter("auth_token_cache", "Token verifications by cache result", ["result"])
+RATE_LIMITED = Counter("rate_limited_requests", "Requests rejected by a rate limit", ["rule", "scope"])
+
+access_logger = logging.getLogger("app.access")
+
+class RequestStats:
+    __slots__ = ("redis_commands", "redis_round_trips", "sql_queries", "sql_seconds", "profile")
+
+    def __init__(self):
+        self.redis_commands = 0
+        self.redis_round_trips = 0
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.profile = None  # app.profiling.Profile while the request is profiled
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+class InstrumentedConnection(Connection):
+    def pack_command(self, *args):
+        # Pipelines pack each of their commands through here too
+        name = args[0].decode() if isinstance(args[0], bytes) else str(args[0])
+        REDIS_COMMANDS.labels(name.split(" ", 1)[0].upper()).inc()
+        stats = current_request.get()
+        if stats is not None:
+            stats.redis_commands += 1
+            if stats.profile is not None:
+                stats.profile.pending.append(name)
+        return super().pack_command(*args)
+
+    async def send_packed_command(self, command, check_health: bool = True):
+        REDIS_ROUND_TRIPS.inc()
+        stats = current_request.get()
+        if stats is not None:
+            stats.redis_round_trips += 1
+            if stats.profile is not None:
+                stats.profile.redis_sent()
+        return await super().send_packed_command(command, check_health)
+
+    async def read_response(self, *args, **kwargs):
+        response = await super().read_response(*args, **kwargs)
+        stats = current_request.get()
+        if stats is not None and stats.profile is not None:
+            stats.profile.redis_received()
+        return response
+
+def instrument_engine(engine: AsyncEngine):
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["query_start"].pop()
+        elapsed = time.perf_counter() - start
+        SQL_LATENCY.observe(elapsed)
+        stats = current_request.get()
+        if stats is not None:
+            stats.sql_queries += 1
+            stats.sql_seconds += elapsed
+            if stats.profile is not None:
+                stats.profile.add_span("sql", statement[:SQL_SPAN_CHARS], start, start + elapsed)
+
+def record_span(kind: str, name: str, start: float):
+    # For work the Redis and SQL hooks don't see, e.g. bcrypt in its thread pool
+    stats = current_request.get()
+    if stats is not None and stats.profile is not None:
+        stats.profile.add_span(kind, name, start, time.perf_counter())
+
+def route_template(scope: dict) -> str:
+    # The matched route's path keeps label cardinality bounded, raw paths carry queue codes
+    return getattr(scope.get("route"), "path", None) or "unmatched"
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            IN_FLIGHT.dec()
+            current_request.reset(token)
+            route = route_template(scope)
+            REQUEST_LATENCY.labels(scope["method"], route, status).observe(elapsed)
+            REDIS_PER_REQUEST.observe(stats.redis_commands)
+            REDIS_ROUND_TRIPS_PER_REQUEST.observe(stats.redis_round_trips)
+            SQL_PER_REQUEST.observe(stats.sql_queries)
+            if status >= 500 or elapsed >= SLOW_REQUEST_SECONDS or random.random() < ACCESS_LOG_SAMPLE_RATE:
+                access_logger.info(
+                    f"{scope['method']} {route} {status} {elapsed * 1000:.1f}ms "
+                    f"redis={stats.redis_commands}/{stats.redis_round_trips} "
+                    f"sql={stats.sql_queries}/{stats.sql_seconds * 1000:.1f}ms"
+                )
+
+async def queue_metrics(rdb: Redis) -> list:
+    labels = ["queue"] if METRICS_PER_QUEUE else []
+    size = GaugeMetricFamily("queue_size", "People waiting in the queue", labels=labels)
+    parties = GaugeMetricFamily("queue_parties", "Parties waiting in the queue", labels=labels)
+    blocks = GaugeMetricFamily("queue_blocks", "Open blocks in the queue", labels=labels)
+    joins = CounterMetricFamily("queue_joins", "Parties that joined the queue", labels=labels)
+    keys = []
+    async for key in rdb.scan_iter(match="queue:{*}:status", count=500):
+        keys.append(key)
+        if len(keys) >= METRICS_MAX_QUEUES:
+            break
+    pipe = rdb.pipeline(transaction=False)
+    for key in keys:
+        pipe.hmget(key, "size", "parties", "block_count", "joins")
+    rows = await pipe.execute() if keys else []
+    families = (size, parties, blocks, joins)
+    if METRICS_PER_QUEUE:
+        for key, values in zip(keys, rows):
+            code = key[key.index("{") + 1:key.index("}")]
+            for family, value in zip(families, values):
+                family.add_metric([code], float(value or 0))
+    else:
+        for i, family in enumerate(families):
+            family.add_metric([], sum(float(values[i] or 0) for values in rows))
+    queues = GaugeMetricFamily("queues", "Queues found in Redis, at most METRICS_MAX_QUEUES")
+    queues.add_metric([], len(keys))
+    return [*families, queues]
+
+def worker_metrics(rdb: Redis, engine: AsyncEngine) -> list:
+    redis_pool = GaugeMetricFamily("redis_pool_connections", "Redis connections in this worker's pool",
+                                   labels=["state"])
+    # Cluster clients keep a pool per node and have no connection_pool
+    pool = getattr(rdb, "connection_pool", None)
+    if pool is not None:
+        redis_pool.add_metric(["in_use"], len(getattr(pool, "_in_use_connections", ())))
+        redis_pool.add_metric(["idle"], len(getattr(pool, "_available_connections", ())))
+        redis_pool.add_metric(["max"], pool.max_connections)
+    db_pool = GaugeMetricFamily("db_pool_connections", "Postgres connections in this worker's pool", labels=["state"])
+    sync_pool = engine.sync_engine.pool
+    if hasattr(sync_pool, "checkedout"):
+        db_pool.add_metric(["in_use"], sync_pool.checkedout())
+        db_pool.add_metric(["idle"], sync_pool.checkedin())
+        db_pool.add_metric(["overflow"], max(sync_pool.overflow(), 0))
+    dropped = CounterMetricFamily("log_records_dropped", "Log records this worker dropped with its log queue full")
+    dropped.add_metric([], dropped_records())
+    return [redis_pool, db_pool, dropped]
+
+class StaticCollector:
+    def __init__(self, families: list):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+async def render(rdb: Redis, engine: AsyncEngine) -> bytes:
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        output = generate_latest(registry)
+    else:
+        output = generate_latest(REGISTRY)
+    scraped = CollectorRegistry()
+    scraped.register(StaticCollector(await queue_metrics(rdb) + worker_metrics(rdb, engine)))
+    return output + generate_latest(scraped)
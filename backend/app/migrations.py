@@ -0,0 +1,132 @@
+import os
+import asyncio
+from redis.asyncio import Redis
+from app.keys import QUEUE_SUFFIXES, queue_key, queue_prefix
+from app.placement import migrate_blocks, BUCKET_CEILING, TIERS
+
+"""
+One-shot Redis data migrations.
+
+Run from the backend directory with `python -m app.migrations`. Every
+migration is idempotent, so it is safe to run while the API is serving.
+
+Moving to the hash-tagged key layout (app/keys.py) has no downtime: deploy
+the new code first, it migrates a queue the first time it touches one, then
+run this module to move the remaining queues in bulk. Each queue's keys are
+renamed by one script, so requests see either the old or the new layout,
+never a mix. Run it before switching to Redis Cluster, the old untagged keys
+cannot be moved atomically once they are spread over slots.
+
+Queue info moved from a JSON document in a one-element list to a hash
+(app/queue_info.py) the same way: readers convert a queue when they find
+the list, this module converts the rest.
+"""
+
+MIGRATE_QUEUE_KEYS_LUA = """
+local code = ARGV[1]
+local prefix = ARGV[2]
+local old = 'queue:' .. code
+if redis.call('EXISTS', KEYS[1]) == 1 or redis.call('EXISTS', old) == 0 then
+    return 0
+end
+
+local function move(from, to)
+    if redis.call('EXISTS', from) == 1 then
+        redis.call('RENAME', from, to)
+    end
+end
+
+local seqs = redis.call('LRANGE', 'blocks:' .. code, 0, -1)
+for _, seq in ipairs(seqs) do
+    -- JSON blocks from before the compact layout live inside the list itself
+    if string.sub(seq, 1, 1) ~= '{' then
+        for _, suffix in ipairs({'', ':parties', ':reserved'}) do
+            move('block:' .. code .. ':' .. seq .. suffix, prefix .. 'block:' .. seq .. suffix)
+        end
+    end
+end
+move('blocks:' .. code, prefix .. 'blocks')
+for i = 3, #ARGV do
+    move(old .. ':' .. ARGV[i], prefix .. ARGV[i])
+end
+move(old, KEYS[1])
+return 1
+"""
+
+MIGRATE_QUEUE_INFO_LUA = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'list' then
+    return 0
+end
+local info = cjson.decode(redis.call('LINDEX', KEYS[1], 0))
+local fields = {}
+for field, value in pairs(info) do
+    -- Same per-field JSON encoding as app/queue_info.py, null included
+    table.insert(fields, field)
+    table.insert(fields, cjson.encode(value))
+end
+redis.call('DEL', KEYS[1])
+if #fields > 0 then
+    redis.call('HSET', KEYS[1], unpack(fields))
+end
+return 1
+"""
+
+def queue_key_suffixes() -> list[str]:
+    suffixes = list(QUEUE_SUFFIXES)
+    for tier in TIERS:
+        suffixes.extend(f"{tier}:{r}" for r in range(1, BUCKET_CEILING + 1))
+    return suffixes
+
+async def migrate_queue_keys(rdb: Redis, code: str) -> bool:
+    # True if the queue was found under its untagged keys and moved
+    script = rdb.register_script(MIGRATE_QUEUE_KEYS_LUA)
+    args = [code, queue_prefix(code), *queue_key_suffixes()]
+    return bool(await script(keys=[queue_key(code)], args=args))
+
+async def migrate_queue_info(rdb: Redis, code: str) -> bool:
+    # True if the queue info was a JSON list and is now a hash
+    script = rdb.register_script(MIGRATE_QUEUE_INFO_LUA)
+    return bool(await script(keys=[queue_key(code)]))
+
+async def migrate_all_queue_keys(rdb: Redis) -> int:
+    migrated = 0
+    async for key in rdb.scan_iter(match="queue:*:service_provider_id", count=500):
+        code = key.split(":")[1]
+        if not code.startswith("{") and await migrate_queue_keys(rdb, code):
+            migrated += 1
+    # Provider indexes are rebuilt under their tagged names on first listing, including
+    # ones marked built while some of their queues were still in the untagged layout
+    async for key in rdb.scan_iter(match="provider:[0-9]*:queues*", count=500):
+        await rdb.delete(key)
+    async for key in rdb.scan_iter(match="provider:{*}:queues:built", count=500):
+        await rdb.delete(key)
+    return migrated
+
+async def migrate_all_blocks(rdb: Redis) -> int:
+    # Convert every queue's JSON blocks list to the compact per-block layout
+    migrated = 0
+    async for key in rdb.scan_iter(match="queue:{*}:blocks", count=500):
+        code = key.split("{", 1)[1].split("}", 1)[0]
+        if await migrate_blocks(rdb, code):
+            migrated += 1
+    return migrated
+
+async def migrate_all_queue_info(rdb: Redis) -> int:
+    migrated = 0
+    # Matches the info keys only, every other queue key has a suffix after the tag
+    async for key in rdb.scan_iter(match="queue:{*}", count=500, _type="list"):
+        code = key.split("{", 1)[1].split("}", 1)[0]
+        if await migrate_queue_info(rdb, code):
+            migrated += 1
+    return migrated
+
+async def main(rdb: Redis):
+    print(f"Moved keys for {await migrate_all_queue_keys(rdb)} queues")
+    print(f"Converted info for {await migrate_all_queue_info(rdb)} queues")
+    print(f"Migrated blocks for {await migrate_all_blocks(rdb)} queues")
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    rdb = Redis(host=os.getenv('REDIS_HOST'), port=os.getenv('REDIS_PORT'), db=0, decode_responses=True)
+    asyncio.run(main(rdb))
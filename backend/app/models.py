@@ -1,10 +1,10 @@
-from sqlalchemy import Column, String, Integer, ForeignKey
+from sqlalchemy import Column, String, Integer, ForeignKey, JSON
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import MutableList
 from sqlalchemy import DateTime, Boolean
 from sqlalchemy.orm import relationship
-from datetime import datetime, timezone
+from app.utils import utcnow
 
 Base = declarative_base()
 
@@ -20,10 +20,10 @@ class Party(Base):
     name = Column(String)
     size = Column(Integer)
     priority = Column(Integer, default=0)
-    block_id = Column(String, ForeignKey("blocks.id"))  # queue:{code}:block_id
+    block_id = Column(String, ForeignKey("blocks.id"))  # Block.id of the block they were dispatched in
     block = relationship("Block", back_populates="parties")
 
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utcnow)
     last_login = Column(DateTime)
 
 """
@@ -37,7 +37,8 @@ class ServiceProvider(Base):
     email = Column(String, unique=True, nullable=False)
     hashed_password = Column(String, nullable=False)
     location = Column(String, nullable=True)
-    queue_codes = Column(MutableList.as_mutable(ARRAY(String)), nullable=False)  # List of queue codes
+    # SQLite (used by the in-process benchmarks) has no arrays, a JSON list stands in
+    queue_codes = Column(MutableList.as_mutable(ARRAY(String).with_variant(JSON(), "sqlite")), nullable=False)  # List of queue codes
     blocks = relationship("Block", back_populates="service_provider")
 
     def __init__(self, **kwargs):
@@ -45,7 +46,7 @@ class ServiceProvider(Base):
         if self.queue_codes is None:
             self.queue_codes = []
 
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utcnow)
     last_login = Column(DateTime)
 
 """
@@ -55,12 +56,27 @@ Is the building block for a queue.
 """
 class Block(Base):
     __tablename__ = "blocks"
-    id = Column(String, primary_key=True)
+    id = Column(String, primary_key=True)  # "{code}-{seq}.{instance}", see app/dispatch.py
     capacity = Column(Integer)  # max number of people in the block
     status = Column(String)
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utcnow)
     dispatched_at = Column(DateTime)
     service_provider_id = Column(Integer, ForeignKey("service_providers.id"))
     service_provider = relationship("ServiceProvider", back_populates="blocks")
     parties = relationship("Party", back_populates="block")
     queue_code = Column(String)  # 6-digit alphanumeric code associated with the block's queue
+
+"""
+Append-only history of queue activity (joins, leaves, dispatches, ...).
+Written behind the request path from the queue_events Redis Stream,
+keyed by the stream entry id so redelivered entries are ignored.
+"""
+class QueueEvent(Base):
+    __tablename__ = "queue_events"
+    id = Column(String, primary_key=True)  # Redis Stream entry id, e.g. "1723012345678-0"
+    type = Column(String, nullable=False)
+    queue_code = Column(String, index=True)
+    phone = Column(String)
+    block_id = Column(String)
+    party_size = Column(Integer)
+    created_at = Column(DateTime)
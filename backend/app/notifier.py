@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Optional
+from fastapi.requests import HTTPConnection
+from redis.asyncio import Redis
+from app.codec import loads
+from app.keys import events_channel, parties_key, status_key
+
+"""
+Fans queue events out to connected WebSocket/SSE clients.
+
+The placement scripts PUBLISH every join, leave and dispatch on
+`queue:{code}:events`. Each worker keeps a single pub/sub connection and
+subscribes to a queue's channel only while at least one local client is
+listening, so Redis sees one subscription per active queue per worker no
+matter how many phones are connected.
+"""
+
+CLIENT_BUFFER = 64  # events buffered per client before the oldest are dropped
+KEEPALIVE_SECONDS = 15
+
+class QueueNotifier:
+    def __init__(self, rdb: Redis):
+        self.rdb = rdb
+        self.pubsub = rdb.pubsub()
+        self.listeners: dict[str, set[asyncio.Queue]] = {}
+        self.lock = asyncio.Lock()
+        self.reader = None
+
+    async def subscribe(self, code: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=CLIENT_BUFFER)
+        async with self.lock:
+            if code not in self.listeners:
+                self.listeners[code] = set()
+                await self.pubsub.subscribe(events_channel(code))
+            self.listeners[code].add(queue)
+            # The pub/sub connection only exists after the first subscribe
+            if self.reader is None:
+                self.reader = asyncio.create_task(self.read())
+        return queue
+
+    async def unsubscribe(self, code: str, queue: asyncio.Queue):
+        async with self.lock:
+            listeners = self.listeners.get(code)
+            if listeners is None:
+                return
+            listeners.discard(queue)
+            if not listeners:
+                del self.listeners[code]
+                await self.pubsub.unsubscribe(events_channel(code))
+
+    async def read(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Queue event listener error: {e}")
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            code = message["channel"].split(":")[1]
+            event = loads(message["data"])
+            for queue in self.listeners.get(code, ()):
+                if queue.full():
+                    # Slow client, drop its oldest event rather than stall everyone
+                    queue.get_nowait()
+                queue.put_nowait(dict(event))
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.pubsub.aclose()
+
+"""Dependency to get the worker's notifier, created in the lifespan hook"""
+def get_notifier(conn: HTTPConnection) -> QueueNotifier:
+    return conn.app.state.notifier
+
+def block_seq(block_id: str) -> int:
+    return int(block_id.rsplit("-", 1)[1])
+
+async def watch_queue(notifier: QueueNotifier, rdb: Redis, code: str, phone: str) -> AsyncIterator[Optional[dict]]:
+    """
+    Yields queue events for one client, adding the client's own block and
+    position (blocks ahead of theirs) under "party" when they are in the
+    queue. Yields None when nothing happened for KEEPALIVE_SECONDS so callers
+    can ping.
+    """
+    # Subscribe before taking the snapshot so nothing falls in between
+    queue = await notifier.subscribe(code)
+    try:
+        pipe = rdb.pipeline()
+        pipe.hget(parties_key(code), phone)
+        pipe.hgetall(status_key(code))
+        block, status = await pipe.execute()
+        block = int(block) if block else None
+        event = {
+            "type": "snapshot",
+            "queue_size": int(status.get("size", 0)),
+            "serving_block": int(status["serving_block"]) if "serving_block" in status else None,
+        }
+        while True:
+            if event is not None:
+                # Other parties' phone numbers never leave the server
+                if event.pop("phone", None) == phone:
+                    block = block_seq(event["block_id"]) if event["type"] == "join" else None
+                if event["type"] == "dispatch" and block is not None and block_seq(event["block_id"]) == block:
+                    event["party"] = {"block_id": f"{code}-{block}", "dispatched": True}
+                    block = None
+                serving = event.get("serving_block")
+                if block is not None and serving is not None:
+                    event["party"] = {"block_id": f"{code}-{block}", "position": block - serving}
+            yield event
+            try:
+                event = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                event = None
+    finally:
+        await notifier.unsubscribe(code, queue)
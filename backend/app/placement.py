@@ -0,0 +1,419 @@
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+from app.keys import PREFIX_LUA
+from app.keys import block_capacity_key, block_counter_key, blocks_key, bucket_key, packing_key, parties_key, priority_slots_key, queue_key, status_key
+from app.event_log import append_events
+
+"""
+Placement engine for parties joining a queue.
+
+All keys of a queue share the `queue:{CODE}:` hash tag (see app/keys.py),
+shortened to `q:` below. Blocks live in a compact layout: `q:blocks` lists
+block sequence numbers in dispatch order, `q:block:{seq}` is a small hash
+holding capacity, used size, status and created_at, and
+`q:block:{seq}:parties` maps each phone to a compact "size|priority|name"
+entry. `q:parties` maps phones to the block they were placed in, and
+`q:status` holds the running totals (size, parties, block_count,
+serving_block) read by /queue/status, and a lifetime `joins` count. Every change is published for live
+clients by the script and appended to the event stream right after it.
+
+Blocks that still have room are indexed in sorted sets bucketed by remaining
+capacity (`q:open:{r}`, scored by sequence number). Blocks with at
+least BUCKET_CEILING seats left share the top bucket. Finding the earliest
+block that fits a party is then a handful of ZRANGE calls regardless of how
+many blocks the queue holds, and the whole pick-and-update runs as a single
+Lua script so concurrent joins never overwrite each other.
+
+Queues created with max_priority_slots = K hold K seats of every block for
+parties with priority > 0. Those seats are a second pool with their own
+buckets (`q:priority:{r}`) and are tracked in the block hash as
+reserved / reserved_used. Regular parties only fit in the other C - K seats
+and priority parties only in the K reserved ones, so K is also a cap: no
+block holds more than K priority guests. A priority party larger than K is
+seated in regular seats like any other party. `q:block:{seq}:reserved` records who sits in a reserved
+seat so leaving returns it to the right pool. With K = 0 every party is
+placed the same way.
+
+The same bucket heads drive every packing policy (QueueInfo.packing_policy):
+first_fit takes the earliest block that fits, best_fit the one with the
+least room left, and lookahead the tightest fit within lookahead_window
+blocks of the earliest. Each is at most BUCKET_CEILING ZRANGEs per tier.
+"""
+
+BUCKET_CEILING = 16  # remaining capacities >= this share one bucket
+ROOMY_SCAN_LIMIT = 32  # how far to look into the top bucket for oversized parties
+DEFAULT_BLOCK_CAPACITY = 10
+TIERS = ("open", "priority")  # bucket sets for regular and reserved seats
+DEFAULT_LOOKAHEAD_WINDOW = 4  # blocks considered past the earliest fit by "lookahead"
+
+PLACE_PARTY_LUA = PREFIX_LUA + """
+local blocks_key = KEYS[1]
+local counter_key = KEYS[2]
+local capacity_key = KEYS[3]
+local parties_key = KEYS[4]
+local status_key = KEYS[5]
+local info_key = KEYS[6]
+local slots_key = KEYS[7]
+local code = ARGV[1]
+local ceiling = tonumber(ARGV[2])
+local scan_limit = tonumber(ARGV[3])
+local default_capacity = tonumber(ARGV[4])
+local packing = redis.call('HMGET', KEYS[8], 'policy', 'window')
+local policy = packing[1] or 'first_fit'
+local window = tonumber(packing[2])
+if not window or window < 1 then
+    -- Windows below 1 match no block, stored before QueueInfo rejected them
+    window = tonumber(ARGV[5])
+end
+-- The party being placed; ARGV[6..] holds (phone, entry, size, priority) per party
+local phone, entry, size, priority
+
+if redis.call('EXISTS', info_key) == 0 then
+    return redis.error_reply('QUEUE_NOT_FOUND')
+end
+
+local head = redis.call('LINDEX', blocks_key, 0)
+if head and string.sub(head, 1, 1) == '{' then
+    return redis.error_reply('LEGACY_BLOCKS')
+end
+
+local function block_key(seq)
+    return prefix .. 'block:' .. seq
+end
+
+local function bucket(tier, r)
+    return prefix .. tier .. ':' .. math.min(r, ceiling)
+end
+
+local function publish(event_type, seq)
+    local status = redis.call('HMGET', status_key, 'size', 'serving_block')
+    redis.call('PUBLISH', 'queue:' .. code .. ':events', cjson.encode({
+        type = event_type,
+        phone = phone,
+        block_id = code .. '-' .. seq,
+        party_size = size,
+        queue_size = tonumber(status[1]),
+        serving_block = tonumber(status[2]),
+    }))
+end
+
+-- Seats left in one tier of a block. Blocks from before priority tiers have no reserved seats.
+local function remaining_of(seq, tier)
+    local state = redis.call('HMGET', block_key(seq), 'capacity', 'used', 'reserved', 'reserved_used')
+    local reserved, reserved_used = tonumber(state[3]) or 0, tonumber(state[4]) or 0
+    if tier == 'priority' then
+        return reserved - reserved_used
+    end
+    return tonumber(state[1]) - reserved - (tonumber(state[2]) - reserved_used)
+end
+
+-- Candidate blocks in a tier: the head of every bucket that can hold the party,
+-- each being the earliest block with exactly that much room left
+local function candidates(tier)
+    local found = {}
+    for r = math.min(size, ceiling), ceiling do
+        if r < ceiling then
+            local seq = redis.call('ZRANGE', bucket(tier, r), 0, 0)[1]
+            if seq then
+                table.insert(found, {seq = tonumber(seq), remaining = r})
+            end
+        else
+            -- The top bucket only guarantees `ceiling` seats, so check each block
+            local roomy = redis.call('ZRANGE', bucket(tier, r), 0, scan_limit - 1)
+            for _, seq in ipairs(roomy) do
+                local remaining = remaining_of(seq, tier)
+                if remaining >= size then
+                    table.insert(found, {seq = tonumber(seq), remaining = remaining})
+                    break
+                end
+            end
+        end
+    end
+    return found
+end
+
+-- first_fit takes the earliest block, best_fit the tightest one, and lookahead
+-- the tightest among blocks less than `window` places after the earliest
+local function choose(found)
+    local first
+    for _, c in ipairs(found) do
+        if first == nil or c.seq < first.seq then
+            first = c
+        end
+    end
+    if first == nil or policy == 'first_fit' then
+        return first
+    end
+    local best
+    for _, c in ipairs(found) do
+        if policy == 'best_fit' or c.seq - first.seq < window then
+            if best == nil or c.remaining < best.remaining or (c.remaining == best.remaining and c.seq < best.seq) then
+                best = c
+            end
+        end
+    end
+    return best
+end
+
+local capacity = tonumber(redis.call('GET', capacity_key) or default_capacity)
+local reserved = 0
+if capacity >= 0 then
+    reserved = math.max(math.min(tonumber(redis.call('GET', slots_key) or 0), capacity), 0)
+end
+
+local function place()
+    if size == nil or size < 1 or size % 1 ~= 0 then
+        return {0, 'Party size must be a positive integer'}
+    end
+    if redis.call('HEXISTS', parties_key, phone) == 1 then
+        return {0, 'Party already in queue'}
+    end
+
+    -- Priority parties only sit in the reserved seats, so no block holds more than K of them;
+    -- those that don't fit there take regular seats
+    local tier = 'open'
+    if priority > 0 and reserved > 0 and size <= reserved then
+        tier = 'priority'
+    elseif capacity >= 0 and size > capacity - reserved then
+        return {0, 'Party size exceeds block capacity'}
+    end
+
+    local best
+    if capacity >= 0 then
+        local chosen = choose(candidates(tier))
+        if chosen then
+            best = tostring(chosen.seq)
+        end
+    end
+
+    local function seat(seq)
+        redis.call('HSET', block_key(seq) .. ':parties', phone, entry)
+        if tier == 'priority' then
+            redis.call('SADD', block_key(seq) .. ':reserved', phone)
+        end
+        redis.call('HSET', parties_key, phone, seq)
+        redis.call('HINCRBY', status_key, 'size', size)
+        redis.call('HINCRBY', status_key, 'parties', 1)
+        redis.call('HINCRBY', status_key, 'joins', 1)
+    end
+
+    if best then
+        local remaining = remaining_of(best, tier)
+        redis.call('ZREM', bucket(tier, remaining), best)
+        if remaining - size > 0 then
+            redis.call('ZADD', bucket(tier, remaining - size), best, best)
+        end
+        redis.call('HINCRBY', block_key(best), 'used', size)
+        if tier == 'priority' then
+            redis.call('HINCRBY', block_key(best), 'reserved_used', size)
+        end
+        seat(best)
+        publish('join', best)
+        return {1, code .. '-' .. best}
+    end
+
+    -- No block has room in the party's tier, so open a new one
+    local reserved_used = 0
+    if tier == 'priority' then
+        reserved_used = size
+    end
+    local seq = redis.call('INCR', counter_key)
+    redis.call('HSET', block_key(seq), 'capacity', capacity, 'used', size, 'status', 'open',
+        'reserved', reserved, 'reserved_used', reserved_used, 'created_at', redis.call('TIME')[1])
+    if redis.call('RPUSH', blocks_key, seq) == 1 then
+        redis.call('HSET', status_key, 'serving_block', seq)
+    end
+    if capacity >= 0 then
+        local open_left = capacity - reserved - (size - reserved_used)
+        if open_left > 0 then
+            redis.call('ZADD', bucket('open', open_left), seq, seq)
+        end
+        if reserved - reserved_used > 0 then
+            redis.call('ZADD', bucket('priority', reserved - reserved_used), seq, seq)
+        end
+    end
+    seat(seq)
+    redis.call('HINCRBY', status_key, 'block_count', 1)
+    publish('join', seq)
+    return {1, code .. '-' .. seq}
+end
+
+-- Each party sees the blocks as the previous ones left them, all in one atomic step
+local results = {}
+for i = 6, #ARGV, 4 do
+    phone, entry, size, priority = ARGV[i], ARGV[i + 1], tonumber(ARGV[i + 2]), tonumber(ARGV[i + 3])
+    table.insert(results, place())
+end
+return results
+"""
+
+"""Takes a party out of its block and hands the seats back to the bucket index"""
+REMOVE_PARTY_LUA = PREFIX_LUA + """
+local parties_key = KEYS[1]
+local status_key = KEYS[2]
+local code = ARGV[1]
+local phone = ARGV[2]
+local ceiling = tonumber(ARGV[3])
+
+local seq = redis.call('HGET', parties_key, phone)
+if not seq then
+    return redis.error_reply('Party not in queue')
+end
+
+local key = prefix .. 'block:' .. seq
+local entry = redis.call('HGET', key .. ':parties', phone)
+local size = entry and tonumber(string.match(entry, '^(%d+)'))
+if not size then
+    return redis.error_reply('Party entry is corrupt')
+end
+local state = redis.call('HMGET', key, 'capacity', 'used', 'reserved', 'reserved_used')
+local capacity, used = tonumber(state[1]), tonumber(state[2])
+
+local function publish(event_type, seq)
+    local status = redis.call('HMGET', status_key, 'size', 'serving_block')
+    redis.call('PUBLISH', 'queue:' .. code .. ':events', cjson.encode({
+        type = event_type,
+        phone = phone,
+        block_id = code .. '-' .. seq,
+        party_size = size,
+        queue_size = tonumber(status[1]),
+        serving_block = tonumber(status[2]),
+    }))
+end
+
+local reserved, reserved_used = tonumber(state[3]) or 0, tonumber(state[4]) or 0
+local tier, left = 'open', capacity - reserved - (used - reserved_used)
+if redis.call('SREM', key .. ':reserved', phone) == 1 then
+    tier, left = 'priority', reserved - reserved_used
+    redis.call('HINCRBY', key, 'reserved_used', -size)
+end
+if capacity >= 0 then
+    local bucket = prefix .. tier .. ':'
+    if left > 0 then
+        redis.call('ZREM', bucket .. math.min(left, ceiling), seq)
+    end
+    redis.call('ZADD', bucket .. math.min(left + size, ceiling), seq, seq)
+end
+redis.call('HINCRBY', key, 'used', -size)
+redis.call('HDEL', key .. ':parties', phone)
+redis.call('HDEL', parties_key, phone)
+redis.call('HINCRBY', status_key, 'size', -size)
+redis.call('HINCRBY', status_key, 'parties', -1)
+publish('leave', seq)
+return {code .. '-' .. seq, size}
+"""
+
+"""Converts a blocks list of JSON BlockInfo dumps to the compact layout"""
+MIGRATE_BLOCKS_LUA = PREFIX_LUA + """
+local blocks_key = KEYS[1]
+local parties_key = KEYS[2]
+local status_key = KEYS[3]
+local code = ARGV[1]
+local ceiling = tonumber(ARGV[2])
+local default_capacity = tonumber(ARGV[3])
+
+local blocks = redis.call('LRANGE', blocks_key, 0, -1)
+if #blocks == 0 or string.sub(blocks[1], 1, 1) ~= '{' then
+    return 0
+end
+
+local seqs = {}
+local total_size, total_parties = 0, 0
+for _, raw in ipairs(blocks) do
+    local ok, block = pcall(cjson.decode, raw)
+    if ok and type(block) == 'table' and block['block_id'] then
+        local seq = string.match(block['block_id'], '(%d+)$')
+        local key = prefix .. 'block:' .. seq
+        local capacity = tonumber(block['capacity']) or default_capacity
+        local used = 0
+        for _, p in ipairs(block['parties'] or {}) do
+            local size = tonumber(p['party_size']) or 1
+            local priority = tonumber(p['priority']) or 0
+            local name = p['name']
+            if type(name) ~= 'string' then
+                name = ''
+            end
+            used = used + size
+            total_parties = total_parties + 1
+            redis.call('HSET', key .. ':parties', p['phone'], size .. '|' .. priority .. '|' .. name)
+            redis.call('HSET', parties_key, p['phone'], seq)
+        end
+        redis.call('HSET', key, 'capacity', capacity, 'used', used, 'status', 'open')
+        local remaining = capacity - used
+        if capacity >= 0 and remaining > 0 then
+            redis.call('ZADD', prefix .. 'open:' .. math.min(remaining, ceiling), seq, seq)
+        end
+        total_size = total_size + used
+        table.insert(seqs, seq)
+    end
+end
+
+redis.call('HSET', status_key, 'size', total_size, 'parties', total_parties, 'block_count', #seqs)
+if #seqs > 0 then
+    redis.call('HSET', status_key, 'serving_block', seqs[1])
+end
+
+redis.call('DEL', blocks_key, prefix .. 'block_remaining')
+for i = 1, #seqs, 1000 do
+    redis.call('RPUSH', blocks_key, unpack(seqs, i, math.min(i + 999, #seqs)))
+end
+return #seqs
+"""
+
+async def place_parties(rdb: Redis, code: str, parties: list[tuple]) -> list[tuple]:
+    """
+    Places (phone, entry, size, priority) parties in order in one script call.
+    Returns (block_id, None) or (None, error) for each party, in the same order.
+    """
+    script = rdb.register_script(PLACE_PARTY_LUA)
+    keys = [
+        blocks_key(code),
+        block_counter_key(code),
+        block_capacity_key(code),
+        parties_key(code),
+        status_key(code),
+        queue_key(code),
+        priority_slots_key(code),
+        packing_key(code),
+    ]
+    args = [code, BUCKET_CEILING, ROOMY_SCAN_LIMIT, DEFAULT_BLOCK_CAPACITY, DEFAULT_LOOKAHEAD_WINDOW]
+    for party in parties:
+        args.extend(party)
+    try:
+        results = await script(keys=keys, args=args)
+    except ResponseError as e:
+        if "LEGACY_BLOCKS" not in str(e):
+            raise
+        # Queue still holds JSON blocks from before the compact layout
+        await migrate_blocks(rdb, code)
+        results = await script(keys=keys, args=args)
+    placed = [(value, None) if ok else (None, value) for ok, value in results]
+    await append_events(rdb, [
+        {"type": "join", "code": code, "phone": phone, "block_id": block_id, "party_size": size}
+        for (phone, _, size, _), (block_id, _) in zip(parties, placed) if block_id
+    ])
+    return placed
+
+async def remove_party(rdb: Redis, code: str, phone: str) -> str:
+    script = rdb.register_script(REMOVE_PARTY_LUA)
+    keys = [parties_key(code), status_key(code)]
+    block_id, size = await script(keys=keys, args=[code, phone, BUCKET_CEILING])
+    await append_events(rdb, [{"type": "leave", "code": code, "phone": phone, "block_id": block_id, "party_size": size}])
+    return block_id
+
+async def migrate_blocks(rdb: Redis, code: str) -> int:
+    script = rdb.register_script(MIGRATE_BLOCKS_LUA)
+    keys = [blocks_key(code), parties_key(code), status_key(code)]
+    return await script(keys=keys, args=[code, BUCKET_CEILING, DEFAULT_BLOCK_CAPACITY])
+
+def packing_settings(queue_info) -> dict:
+    return {
+        "policy": queue_info.packing_policy or "first_fit",
+        "window": queue_info.lookahead_window or DEFAULT_LOOKAHEAD_WINDOW,
+    }
+
+def placement_keys(code: str) -> list[str]:
+    keys = [parties_key(code), status_key(code), packing_key(code)]
+    for tier in TIERS:
+        keys.extend(bucket_key(code, tier, r) for r in range(1, BUCKET_CEILING + 1))
+    return keys
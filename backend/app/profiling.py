@@ -0,0 +1,161 @@
+import os
+import io
+import time
+import random
+import pstats
+import secrets
+import cProfile
+import itertools
+from collections import deque
+from typing import Optional
+from app.metrics import RequestStats, current_request, route_template
+
+"""
+Opt-in request profiling, for finding where a slow worker spends its time.
+
+A request is profiled when it is sampled (PROFILE_SAMPLE_RATE, changeable
+at runtime with PUT /admin/profiles/sampling) or when it carries an
+`X-Profile: <ADMIN_TOKEN>` header. A profiled request records a span for
+every Redis round trip, SQL statement and bcrypt call it makes, and runs
+under cProfile unless another request in the worker already does (cProfile
+sees the whole event loop, so its function table also holds whatever other
+requests ran meanwhile; the spans are the request's own).
+
+Profiles go to a per-worker ring buffer of PROFILE_BUFFER_SIZE entries,
+served by /admin/profiles with the ADMIN_TOKEN bearer token. Requests
+that aren't profiled only pay for the sampling check and, with
+ADMIN_TOKEN set, a look at their header names.
+"""
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", 50))
+PROFILE_TOP_FUNCTIONS = int(os.getenv("PROFILE_TOP_FUNCTIONS", 30))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILE_HEADER = b"x-profile"
+
+sample_rate = PROFILE_SAMPLE_RATE
+profiles = deque(maxlen=PROFILE_BUFFER_SIZE)
+profile_ids = itertools.count(1)
+profiler_busy = False
+
+class Profile:
+    __slots__ = ("started", "spans", "pending", "in_flight", "profiler")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self.pending = []  # Redis commands packed but not sent yet
+        self.in_flight = deque()  # sent round trips: [span, replies still expected]
+        self.profiler = None
+
+    def add_span(self, kind: str, name: str, start: float, end: float):
+        self.spans.append({
+            "type": kind,
+            "name": name,
+            "start_ms": round((start - self.started) * 1000, 3),
+            "duration_ms": round((end - start) * 1000, 3),
+        })
+
+    def redis_sent(self):
+        # A pipeline sends all its commands in one write and reads one reply per command
+        span = {"type": "redis", "name": " ".join(self.pending), "start": time.perf_counter()}
+        self.in_flight.append([span, max(len(self.pending), 1)])
+        self.pending = []
+
+    def redis_received(self):
+        if not self.in_flight:
+            return
+        entry = self.in_flight[0]
+        entry[1] -= 1
+        if entry[1] == 0:
+            self.in_flight.popleft()
+            span = entry[0]
+            self.add_span("redis", span["name"], span["start"], time.perf_counter())
+
+def set_sample_rate(rate: float):
+    global sample_rate
+    sample_rate = rate
+
+def is_admin(authorization: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN) and secrets.compare_digest(authorization or "", f"Bearer {ADMIN_TOKEN}")
+
+def wants_profile(scope: dict) -> bool:
+    if sample_rate and random.random() < sample_rate:
+        return True
+    if ADMIN_TOKEN:
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER:
+                return secrets.compare_digest(value, ADMIN_TOKEN.encode())
+    return False
+
+def function_table(profiler: cProfile.Profile) -> str:
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+    return output.getvalue()
+
+def summary(record: dict) -> dict:
+    return {key: value for key, value in record.items() if key not in ("spans", "profiler")}
+
+def details(record: dict) -> dict:
+    profiler = record["profiler"]
+    return {**summary(record), "spans": record["spans"], "functions": function_table(profiler) if profiler else None}
+
+def find_profile(profile_id: int) -> Optional[dict]:
+    return next((record for record in profiles if record["id"] == profile_id), None)
+
+class ProfilingMiddleware:
+    # Inside MetricsMiddleware, whose RequestStats the spans are attached to
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not wants_profile(scope):
+            return await self.app(scope, receive, send)
+        global profiler_busy
+        stats = current_request.get()
+        token = None
+        if stats is None:
+            stats = RequestStats()
+            token = current_request.set(stats)
+        profile = stats.profile = Profile()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        if not profiler_busy:
+            try:
+                profiler = cProfile.Profile()
+                profiler.enable()
+                profile.profiler = profiler
+                profiler_busy = True
+            except ValueError:
+                pass  # another profiler owns the interpreter, spans only
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            if profile.profiler is not None:
+                profile.profiler.disable()
+                profiler_busy = False
+            elapsed = time.perf_counter() - profile.started
+            stats.profile = None
+            if token is not None:
+                current_request.reset(token)
+            profiles.append({
+                "id": next(profile_ids),
+                "at": time.time(),
+                "method": scope["method"],
+                "route": route_template(scope),
+                "path": scope["path"],
+                "status": status,
+                "duration_ms": round(elapsed * 1000, 3),
+                "redis_commands": stats.redis_commands,
+                "redis_round_trips": stats.redis_round_trips,
+                "sql_queries": stats.sql_queries,
+                "sql_ms": round(stats.sql_seconds * 1000, 3),
+                "spans": profile.spans,
+                "profiler": profile.profiler,
+            })
@@ -0,0 +1,110 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Optional
+from fastapi import Depends, HTTPException, Path
+from redis.asyncio import Redis
+from app.cache import TTLCache
+from app.db import get_redis
+from app.keys import service_provider_key
+from app.migrations import migrate_queue_keys
+from app.queue_info import read_info, info_from_result
+
+"""
+Per-worker cache of queue metadata: the QueueInfo fields and the owner.
+
+Provider routes load both through the `get_queue_meta` dependency, one
+pipelined round trip on a miss and none on a hit. Queue writers
+(create, update, delete) publish the code on QUEUE_INVALIDATION_CHANNEL
+and every worker's listener drops its copy. Pub/sub is at-most-once, so
+entries also expire after QUEUE_CACHE_TTL seconds and the cache is cleared
+whenever the listener (re)subscribes.
+
+A load that races an invalidation must not put the old value back, so
+every invalidation bumps a generation counter and loads only cache what
+they read if the generation didn't move meanwhile.
+"""
+
+QUEUE_INVALIDATION_CHANNEL = "queue:invalidations"
+QUEUE_CACHE_TTL = float(os.getenv("QUEUE_CACHE_TTL", 30))
+queue_cache = TTLCache(maxsize=int(os.getenv("QUEUE_CACHE_SIZE", 10000)))
+generation = 0
+
+class QueueMeta:
+    __slots__ = ("code", "info", "owner")
+
+    def __init__(self, code: str, info: dict, owner: Optional[str]):
+        self.code = code
+        self.info = info  # shared with other requests, copy before changing it
+        self.owner = owner
+
+def forget_queue(code: str):
+    global generation
+    generation += 1
+    queue_cache.pop(code)
+
+def forget_all():
+    global generation
+    generation += 1
+    queue_cache.clear()
+
+async def fetch_queue_meta(rdb: Redis, code: str) -> Optional[QueueMeta]:
+    pipe = rdb.pipeline()
+    read_info(pipe, code)
+    pipe.get(service_provider_key(code))
+    result, owner = await pipe.execute(raise_on_error=False)
+    info = await info_from_result(rdb, code, result)
+    if info is None:
+        # Queues created before the hash-tagged layout are moved on first touch
+        if await migrate_queue_keys(rdb, code):
+            return await fetch_queue_meta(rdb, code)
+        return None
+    return QueueMeta(code, info, owner)
+
+async def load_queue_meta(rdb: Redis, code: str) -> Optional[QueueMeta]:
+    meta = queue_cache.get(code)
+    if meta is not None:
+        return meta
+    loaded_at = generation
+    meta = await fetch_queue_meta(rdb, code)
+    if meta is not None and generation == loaded_at:
+        queue_cache.set(code, meta, time.time() + QUEUE_CACHE_TTL)
+    return meta
+
+async def listen_for_queue_invalidations(rdb: Redis):
+    while True:
+        try:
+            async with rdb.pubsub() as pubsub:
+                await pubsub.subscribe(QUEUE_INVALIDATION_CHANNEL)
+                # Invalidations published while we were disconnected are lost, start cold
+                forget_all()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        forget_queue(message["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Queue invalidation listener error: {e}")
+            forget_all()
+            await asyncio.sleep(1)
+
+"""Dependency returning the queue named by the `code` path parameter, 404 if there is none"""
+async def get_queue_meta(
+    code: str = Path(..., pattern="^[A-Z0-9]{6}$"),
+    rdb: Redis = Depends(get_redis)
+) -> QueueMeta:
+    meta = await load_queue_meta(rdb, code)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="Queue not found")
+    return meta
+
+"""Same, but always read from Redis, for routes that write back what they read or remove the queue"""
+async def get_fresh_queue_meta(
+    code: str = Path(..., pattern="^[A-Z0-9]{6}$"),
+    rdb: Redis = Depends(get_redis)
+) -> QueueMeta:
+    meta = await fetch_queue_meta(rdb, code)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="Queue not found")
+    return meta
@@ -0,0 +1,152 @@
+import re
+import hashlib
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from app.utils import sanitize_str
+from app.keys import service_provider_key, legacy_queue_key
+from app.queue_info import read_info, info_from_result
+from app.migrations import migrate_queue_keys
+
+"""
+Per-provider secondary index over queues, backing GET /queues.
+
+Each provider has a sorted set `provider:{ID}:queues` whose members are
+"normalized name\\x00code", all with score 0, so the set is ordered by name
+and a page is a ZRANGE by rank: O(log n + limit). Every word of the name and
+description is also indexed by its prefixes in
+`provider:{ID}:queues:prefix:{prefix}`, with the same members so search
+results come back in name order too. Searches with several words intersect
+the prefix sets into a short-lived key.
+
+The index lives in the provider's cluster slot, not the queue's, so it is
+never written atomically with the queue data. Create and delete update it
+in a second, non-transactional pipeline right after the queue's own MULTI,
+and update sends it in the same non-transactional pipeline as the changed
+fields. A crash in between can leave an entry for a deleted queue, which
+listings skip, or miss a new queue until the provider's index is rebuilt. Providers whose queues predate the index are indexed
+from their queue_codes the first time they list them, moving queues still
+in the untagged layout to their tagged keys on the way. After that
+`provider:{ID}:queues:built` marks them as indexed, so a provider without
+any queues doesn't go back to Postgres on every listing; it is only set
+once none of their codes is left in the untagged layout.
+"""
+
+MAX_PREFIX = 20  # longer search words are matched on their first MAX_PREFIX characters
+SEARCH_TTL_SECONDS = 30
+TOKEN_RE = re.compile(r"\w+")
+INDEXED_FIELDS = ("code", "name", "description")  # what index_entry and prefixes read
+
+# Hash-tagged by provider so ZINTERSTORE over a provider's sets stays in one cluster slot
+def index_key(provider_id) -> str:
+    return f"provider:{{{provider_id}}}:queues"
+
+def built_key(provider_id) -> str:
+    return f"provider:{{{provider_id}}}:queues:built"
+
+def prefix_key(provider_id, prefix: str) -> str:
+    return f"provider:{{{provider_id}}}:queues:prefix:{prefix}"
+
+def normalize(text) -> str:
+    return sanitize_str(text or "").lower()
+
+def search_terms(search: str) -> list[str]:
+    return sorted({token[:MAX_PREFIX] for token in TOKEN_RE.findall(normalize(search))})
+
+def index_entry(info: dict) -> str:
+    # sanitize_str strips control characters, so \x00 cannot appear in the name
+    return f"{normalize(info.get('name'))}\x00{info['code']}"
+
+def entry_code(entry: str) -> str:
+    return entry.rsplit("\x00", 1)[1]
+
+def prefixes(info: dict) -> set[str]:
+    text = f"{normalize(info.get('name'))} {normalize(info.get('description'))}"
+    return {
+        token[:n]
+        for token in TOKEN_RE.findall(text)
+        for n in range(1, min(len(token), MAX_PREFIX) + 1)
+    }
+
+def add_to_index(pipe: Pipeline, provider_id, info: dict):
+    entry = index_entry(info)
+    pipe.zadd(index_key(provider_id), {entry: 0})
+    for prefix in prefixes(info):
+        pipe.zadd(prefix_key(provider_id, prefix), {entry: 0})
+
+def remove_from_index(pipe: Pipeline, provider_id, info: dict):
+    entry = index_entry(info)
+    pipe.zrem(index_key(provider_id), entry)
+    for prefix in prefixes(info):
+        pipe.zrem(prefix_key(provider_id, prefix), entry)
+
+def reindex(pipe: Pipeline, provider_id, old: dict, new: dict):
+    old_entry, new_entry = index_entry(old), index_entry(new)
+    old_prefixes, new_prefixes = prefixes(old), prefixes(new)
+    if old_entry == new_entry:
+        # Name unchanged, only the description words moved
+        old_prefixes, new_prefixes = old_prefixes - new_prefixes, new_prefixes - old_prefixes
+    else:
+        pipe.zrem(index_key(provider_id), old_entry)
+        pipe.zadd(index_key(provider_id), {new_entry: 0})
+    for prefix in old_prefixes:
+        pipe.zrem(prefix_key(provider_id, prefix), old_entry)
+    for prefix in new_prefixes:
+        pipe.zadd(prefix_key(provider_id, prefix), {new_entry: 0})
+
+async def search_queues(rdb: Redis, provider_id, search: str, offset: int, limit: int) -> tuple[int, list[str], bool]:
+    """
+    Returns the total number of matches and the codes on the requested page, in name order,
+    and whether the provider's index has been built (see build_index).
+    """
+    terms = search_terms(search) if search else []
+    if search and not terms:
+        return 0, [], True
+    if len(terms) > 1:
+        key = f"{index_key(provider_id)}:search:{hashlib.sha1(' '.join(terms).encode()).hexdigest()}"
+    else:
+        key = prefix_key(provider_id, terms[0]) if terms else index_key(provider_id)
+    pipe = rdb.pipeline(transaction=False)
+    if len(terms) > 1:
+        pipe.zinterstore(key, [prefix_key(provider_id, term) for term in terms], aggregate="MIN")
+        pipe.expire(key, SEARCH_TTL_SECONDS)
+    pipe.zcard(key)
+    pipe.zrange(key, offset, offset + limit - 1)
+    pipe.exists(built_key(provider_id))
+    *_, total, entries, built = await pipe.execute()
+    return total, [entry_code(entry) for entry in entries], bool(built)
+
+async def read_entries(rdb: Redis, codes: list[str]) -> list[tuple]:
+    # (indexed fields, owner id) per code, None for codes not found under their tagged keys
+    pipe = rdb.pipeline(transaction=False)
+    for code in codes:
+        read_info(pipe, code, INDEXED_FIELDS)
+        pipe.get(service_provider_key(code))
+    results = await pipe.execute(raise_on_error=False)
+    return [(await info_from_result(rdb, code, results[2 * i], INDEXED_FIELDS), results[2 * i + 1])
+            for i, code in enumerate(codes)]
+
+async def build_index(rdb: Redis, provider_id, codes: list[str]) -> int:
+    # Index queues created before the index existed, skipping stale or foreign codes
+    entries = dict(zip(codes, await read_entries(rdb, codes)))
+    # Queues still in the untagged layout are moved to their tagged keys first, see app/migrations.py
+    moved = [code for code, (info, _) in entries.items() if info is None and await migrate_queue_keys(rdb, code)]
+    entries.update(zip(moved, await read_entries(rdb, moved)))
+    pipe = rdb.pipeline()
+    indexed = 0
+    for code, (info, owner_id) in entries.items():
+        if info is None or str(owner_id) != str(provider_id):
+            continue
+        add_to_index(pipe, provider_id, info)
+        indexed += 1
+    # Built once every code is indexed or gone, an empty index is still a built one
+    missing = [code for code, (info, _) in entries.items() if info is None]
+    if not any(await exist_legacy(rdb, missing)):
+        pipe.set(built_key(provider_id), 1)
+    await pipe.execute()
+    return indexed
+
+async def exist_legacy(rdb: Redis, codes: list[str]) -> list[bool]:
+    pipe = rdb.pipeline(transaction=False)
+    for code in codes:
+        pipe.exists(legacy_queue_key(code))
+    return [bool(found) for found in await pipe.execute()]
@@ -0,0 +1,70 @@
+from typing import Optional
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import ResponseError
+from app.codec import dumps, loads
+from app.keys import queue_key
+from app.migrations import migrate_queue_info
+from app.queues import QueueInfo
+
+"""
+Storage of a queue's QueueInfo in `queue:{CODE}`.
+
+The key is a hash with one field per QueueInfo attribute, each value JSON
+encoded so types survive the round trip. Writers HSET only the fields they
+change, so concurrent updates of different fields (closing a queue mid-rush
+while its description is edited) never overwrite each other, and readers
+that need a few fields HMGET just those.
+
+Queues created before the hash kept the whole QueueInfo as JSON in a
+one-element list. A read that gets WRONGTYPE converts the queue in place
+and reads again; `python -m app.migrations` converts the rest.
+"""
+
+# Placement reads these from their own keys, set once by initialize_queue
+IMMUTABLE_FIELDS = ("code", "service_provider_id", "max_block_capacity", "max_priority_slots")
+INFO_DEFAULTS = QueueInfo().to_dict()
+
+def encode_info(info: dict) -> dict:
+    return {field: dumps(value) for field, value in info.items()}
+
+def decode_info(fields: dict) -> Optional[dict]:
+    return {field: loads(value) for field, value in fields.items()} or None
+
+def decode_projection(fields: tuple, values: list) -> Optional[dict]:
+    if all(value is None for value in values):
+        return None
+    return {field: None if value is None else loads(value) for field, value in zip(fields, values)}
+
+def complete_info(info: dict) -> dict:
+    # QueueInfo's shape for responses, defaults for fields stored before they existed, no validation pass
+    return {field: info.get(field, default) for field, default in INFO_DEFAULTS.items()}
+
+def write_info(pipe: Pipeline, code: str, info: dict):
+    pipe.hset(queue_key(code), mapping=encode_info(info))
+
+def read_info(pipe: Pipeline, code: str, fields: tuple = ()):
+    # Decode the result with info_from_result, the pipeline must run with raise_on_error=False
+    if fields:
+        pipe.hmget(queue_key(code), fields)
+    else:
+        pipe.hgetall(queue_key(code))
+
+async def info_from_result(rdb: Redis, code: str, result, fields: tuple = ()) -> Optional[dict]:
+    if isinstance(result, ResponseError):
+        if not str(result).startswith("WRONGTYPE") or not await migrate_queue_info(rdb, code):
+            raise result
+        return await get_info(rdb, code, *fields)
+    return decode_projection(fields, result) if fields else decode_info(result)
+
+"""Reads the queue's info, only the given fields if any (missing ones are None), None if there is no queue"""
+async def get_info(rdb: Redis, code: str, *fields: str) -> Optional[dict]:
+    [info] = await get_infos(rdb, [code], *fields)
+    return info
+
+async def get_infos(rdb: Redis, codes: list[str], *fields: str) -> list[Optional[dict]]:
+    pipe = rdb.pipeline(transaction=False)
+    for code in codes:
+        read_info(pipe, code, fields)
+    results = await pipe.execute(raise_on_error=False)
+    return [await info_from_result(rdb, code, result, fields) for code, result in zip(codes, results)]
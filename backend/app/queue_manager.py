@@ -1,53 +1,253 @@
 import uuid
-import json
-from redis import Redis
-from app.queues import PartyInfo, BlockInfo, QueueInfo, QueueInfoRedis
-
-def add_party_to_block(rdb: Redis, code: str, party: PartyInfo):
-    blocks_key = f"blocks:{code}"
-    blocks = rdb.lrange(blocks_key, 0, -1)
-
-    # Try to find an existing block with enough capacity
-    for i, block_json in enumerate(blocks):
-        try:
-            block = json.loads(block_json)
-        except (TypeError, json.JSONDecodeError):
-            continue  # Skip bad block data
-        capacity = block.get("capacity", 10)
-        current_size = sum(p["party_size"] for p in block.get("parties", []))
-
-        if current_size + party.party_size <= capacity:
-            block["parties"].append(party.to_dict())
-            # Update block in Redis
-            rdb.lset(blocks_key, i, json.dumps(block))
-            return {"phone": party.phone, "block_id": block["block_id"]}
-
-    # No available block found, so create a new one
-    block_counter_key = f"queue:{code}:block_counter"
-    next_block_id = rdb.incr(block_counter_key)
-    new_block_id = f"{code}-{next_block_id}"
-    new_block_capacity_key = f"queue:{code}:block_capacity"
-    block_capacity = int(rdb.get(new_block_capacity_key) or 10)
-    new_block = BlockInfo(block_id=new_block_id, parties=[party.to_dict()], capacity=block_capacity)
-    rdb.rpush(blocks_key, json.dumps(new_block.to_dict()))
-    return {"party_id": party.party_id, "block_id": new_block_id}
-
-def initialize_queue(rdb: Redis, queue_info: QueueInfo):
-    # Start fresh by deleting any possible existing data
-    blocks_key = f"blocks:{queue_info.code}"
-    rdb.delete(blocks_key)
-
-    # Store the queue data that will be used by the blocks for initialization
-    # Capacity and ServiceProviderId CANNOT be changed after initialization
-    block_counter_key = f"queue:{queue_info.code}:block_counter"
-    rdb.set(block_counter_key, 0)
-    block_capacity_key = f"queue:{queue_info.code}:block_capacity"
-    rdb.set(block_capacity_key, queue_info.max_block_capacity)
-    service_provider_id_key = f"queue:{queue_info.code}:service_provider_id"
-    rdb.set(service_provider_id_key, queue_info.service_provider_id)
-    
-    # Set the rest of the queue data as json
-    queue_key = f"queue:{queue_info.code}"
-    rdb.delete(queue_key)
-    rdb.rpush(queue_key, json.dumps(queue_info.to_dict()))
+from redis.asyncio import Redis
+from typing import Optional
+from app.queues import PartyInfo, BlockInfo, QueueInfo, QueueInfoRedis, QueueStatus
+from redis.exceptions import ResponseError
+from app.placement import place_parties, remove_party, placement_keys, packing_settings
+from app.event_log import append_event, add_event
+from app import queue_index
+from app.estimator import block_eta, format_wait
+from app.keys import queue_key, blocks_key, block_key, block_parties_key, block_reserved_key, block_counter_key
+from app.keys import block_capacity_key, priority_slots_key, packing_key, service_provider_key, parties_key
+from app.keys import status_key, eta_key, outbox_key, instance_key, legacy_queue_key
+from app.migrations import migrate_queue_keys
+from app.queue_cache import QUEUE_INVALIDATION_CHANNEL, forget_queue
+from app.queue_info import read_info, info_from_result, write_info, get_info
+from app.models import ServiceProvider
+from app.utils import generate_code
+from sqlalchemy import func, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+def encode_party(party: PartyInfo) -> str:
+    # Compact roster entry, the phone is the roster field name
+    return f"{party.party_size}|{party.priority}|{party.name}"
+
+def decode_party(phone: str, entry: str) -> PartyInfo:
+    size, priority, name = entry.split("|", 2)
+    return PartyInfo(phone=phone, name=name, party_size=int(size), priority=int(priority))
+
+async def add_party_to_block(rdb: Redis, code: str, party: PartyInfo):
+    # Pick a block with room per the queue's packing policy and add the party in one atomic step
+    [placement] = await add_parties_to_blocks(rdb, code, [party])
+    if "error" in placement:
+        # The party was turned away (full, duplicate, ...), not a Redis failure
+        raise ValueError(placement["error"])
+    return placement
+
+async def add_parties_to_blocks(rdb: Redis, code: str, parties: list[PartyInfo]) -> list[dict]:
+    entries = [(party.phone, encode_party(party), party.party_size, party.priority) for party in parties]
+    try:
+        placed = await place_parties(rdb, code, entries)
+    except ResponseError as e:
+        if "QUEUE_NOT_FOUND" not in str(e):
+            raise
+        if not await migrate_queue_keys(rdb, code):
+            raise ResponseError("Queue not found")
+        placed = await place_parties(rdb, code, entries)
+    return [
+        {"phone": party.phone, "block_id": block_id} if error is None else {"phone": party.phone, "error": error}
+        for party, (block_id, error) in zip(parties, placed)
+    ]
+
+async def remove_party_from_block(rdb: Redis, code: str, phone: str):
+    try:
+        block_id = await remove_party(rdb, code, phone)
+    except ResponseError as e:
+        if "Party not in queue" not in str(e) or not await migrate_queue_keys(rdb, code):
+            raise
+        block_id = await remove_party(rdb, code, phone)
+    return {"phone": phone, "block_id": block_id}
+
+STATUS_FIELDS = ("name", "description", "image_url", "wait_time_estimate")
+
+async def get_status(rdb: Redis, code: str, phone: Optional[str] = None) -> Optional[QueueStatus]:
+    # Counters are kept current by the placement scripts, so this is one round trip
+    pipe = rdb.pipeline()
+    pipe.hgetall(status_key(code))
+    read_info(pipe, code, STATUS_FIELDS)
+    pipe.hgetall(eta_key(code))
+    if phone:
+        pipe.hget(parties_key(code), phone)
+    counters, result, eta, *seq = await pipe.execute(raise_on_error=False)
+    seq = seq[0] if seq else None
+    info = await info_from_result(rdb, code, result, STATUS_FIELDS)
+    if info is None:
+        if await migrate_queue_keys(rdb, code):
+            return await get_status(rdb, code, phone)
+        return None
+    block_count = int(counters.get("block_count", 0))
+    serving_block = int(counters["serving_block"]) if "serving_block" in counters else None
+    # A new party lands in the last block at the latest
+    wait = block_eta(eta, max(block_count - 1, 0))
+    party_eta = block_eta(eta, int(seq) - serving_block) if seq and serving_block is not None else None
+    return QueueStatus(
+        size=int(counters.get("size", 0)),
+        parties=int(counters.get("parties", 0)),
+        block_count=block_count,
+        serving_block=serving_block,
+        wait_time_estimate=format_wait(wait) or info["wait_time_estimate"],
+        wait_seconds=wait,
+        party_block=int(seq) if seq else None,
+        party_eta_seconds=party_eta,
+        name=info["name"],
+        description=info["description"],
+        image_url=info["image_url"],
+    )
+
+async def get_live_fields(rdb: Redis, codes: list[str]) -> list[dict]:
+    """
+    Current size and wait estimate of each queue, to overlay on its QueueInfo, whose
+    stored size and wait_time_estimate are never updated. The estimate is the same as
+    /queue/status gives, and only overlaid once the queue has one.
+    """
+    pipe = rdb.pipeline(transaction=False)
+    for code in codes:
+        pipe.hmget(status_key(code), "size", "block_count")
+        pipe.hgetall(eta_key(code))
+    results = await pipe.execute()
+    live = []
+    for i in range(len(codes)):
+        (size, block_count), eta = results[2 * i], results[2 * i + 1]
+        fields = {"size": int(size or 0)}
+        estimate = format_wait(block_eta(eta, max(int(block_count or 0) - 1, 0)))
+        if estimate:
+            fields["wait_time_estimate"] = estimate
+        live.append(fields)
+    return live
+
+async def get_blocks(rdb: Redis, code: str) -> list[BlockInfo]:
+    seqs = await rdb.lrange(blocks_key(code), 0, -1)
+    pipe = rdb.pipeline()
+    for seq in seqs:
+        pipe.hget(block_key(code, seq), "capacity")
+        pipe.hgetall(block_parties_key(code, seq))
+    results = await pipe.execute()
+    blocks = []
+    for i, seq in enumerate(seqs):
+        capacity, roster = results[2 * i], results[2 * i + 1]
+        parties = [decode_party(phone, entry) for phone, entry in roster.items()]
+        blocks.append(BlockInfo(block_id=f"{code}-{seq}", parties=parties, capacity=int(capacity)))
+    return blocks
+
+CODE_CLAIM_ROUNDS = 8  # round trips allocate_code tries, claiming 1, 2, 4, ... candidates each
+CODE_CLAIM_SECONDS = 300  # a claim initialize_queue never took over frees itself after this
+
+async def allocate_code(rdb: Redis, owner_id) -> str:
+    """Claims a random unused queue code for owner_id and returns it"""
+    # SET NX on the owner key is the claim, so two creates can never get the same code.
+    # A round trip usually claims its one candidate; each miss doubles the batch,
+    # so a crowded code space still takes only a few round trips.
+    for attempt in range(CODE_CLAIM_ROUNDS):
+        candidates = list({generate_code() for _ in range(2 ** attempt)})
+        pipe = rdb.pipeline(transaction=False)
+        for code in candidates:
+            pipe.set(service_provider_key(code), owner_id, nx=True, ex=CODE_CLAIM_SECONDS)
+            pipe.exists(legacy_queue_key(code))
+        results = await pipe.execute()
+        claimed = [code for i, code in enumerate(candidates) if results[2 * i]]
+        # Codes of queues still in the untagged layout are taken too
+        free = [code for i, code in enumerate(candidates) if results[2 * i] and not results[2 * i + 1]]
+        surplus = [code for code in claimed if code not in free[:1]]
+        if surplus:
+            await release_codes(rdb, surplus)
+        if free:
+            return free[0]
+    raise RuntimeError("No free queue code found")
+
+async def release_codes(rdb: Redis, codes: list[str]):
+    pipe = rdb.pipeline(transaction=False)
+    for code in codes:
+        pipe.delete(service_provider_key(code))
+    await pipe.execute()
+
+async def add_provider_queue(db: AsyncSession, service_provider_id: int, code: str) -> bool:
+    # Appends in SQL rather than loading and rewriting the whole list, False if there is no such provider
+    column = ServiceProvider.queue_codes
+    if db.bind.dialect.name == "sqlite":
+        appended = func.json_insert(column, "$[#]", code)  # JSON stand-in for the array, see app/models.py
+    else:
+        appended = func.array_append(column, code)
+    result = await db.execute(
+        update(ServiceProvider)
+        .where(ServiceProvider.id == service_provider_id)
+        .values(queue_codes=appended)
+        .returning(ServiceProvider.id)
+        .execution_options(synchronize_session=False)
+    )
+    return result.scalar_one_or_none() is not None
+
+async def initialize_queue(rdb: Redis, queue_info: QueueInfo):
+    code = queue_info.code
+    info = queue_info.to_dict()
+    # The queue's keys share a slot, so they are all written by one MULTI. Cluster
+    # pipelines only run one when asked, their default is per-node batches.
+    pipe = rdb.pipeline(transaction=True)
+    # Freshly claimed codes have no data, this only clears what a failed delete left behind
+    pipe.delete(queue_key(code), blocks_key(code), *placement_keys(code))
+    # Capacity and ServiceProviderId CANNOT be changed after initialization.
+    # A SET without EX also drops the expiry of allocate_code's claim.
+    pipe.set(service_provider_key(code), queue_info.service_provider_id)
+    pipe.set(block_counter_key(code), 0)
+    pipe.set(instance_key(code), uuid.uuid4().hex[:12])
+    pipe.set(block_capacity_key(code), queue_info.max_block_capacity)
+    pipe.set(priority_slots_key(code), queue_info.max_priority_slots or 0)
+    pipe.hset(packing_key(code), mapping=packing_settings(queue_info))
+    pipe.hset(status_key(code), mapping={"size": 0, "parties": 0, "block_count": 0})
+    # The rest of the queue data, a hash field per attribute
+    write_info(pipe, code, info)
+    await pipe.execute()
+
+    # The provider index and the event stream live in other slots
+    pipe = rdb.pipeline(transaction=False)
+    queue_index.add_to_index(pipe, queue_info.service_provider_id, info)
+    add_event(pipe, {"type": "create", "code": code})
+    # A worker may still cache a deleted queue that had this code
+    pipe.publish(QUEUE_INVALIDATION_CHANNEL, code)
+    await pipe.execute()
     return {"status": "initialized"}
+
+PACKING_FIELDS = {"policy": "packing_policy", "window": "lookahead_window"}
+
+async def update_queue(rdb: Redis, code: str, current_data: dict, changes: dict):
+    """Writes only the changed fields, so concurrent updates of other fields are never lost"""
+    updated_data = {**current_data, **changes}
+    # The queue hash and the provider index live in different slots, no MULTI
+    pipe = rdb.pipeline(transaction=False)
+    write_info(pipe, code, changes)
+    # The packing policy may change at any time, it applies from the next join
+    settings = packing_settings(QueueInfo.from_dict(updated_data))
+    packing = {name: settings[name] for name, field in PACKING_FIELDS.items() if field in changes}
+    if packing:
+        pipe.hset(packing_key(code), mapping=packing)
+    if "name" in changes or "description" in changes:
+        queue_index.reindex(pipe, current_data["service_provider_id"], current_data, updated_data)
+    pipe.publish(QUEUE_INVALIDATION_CHANNEL, code)
+    await pipe.execute()
+    forget_queue(code)
+
+async def delete_queue(rdb: Redis, code: str):
+    seqs = await rdb.lrange(blocks_key(code), 0, -1)
+    info = await get_info(rdb, code, "service_provider_id", *queue_index.INDEXED_FIELDS)
+    pipe = rdb.pipeline(transaction=True)
+    for seq in seqs:
+        pipe.delete(block_key(code, seq), block_parties_key(code, seq), block_reserved_key(code, seq))
+    pipe.delete(service_provider_key(code))
+    pipe.delete(block_counter_key(code))
+    pipe.delete(block_capacity_key(code))
+    pipe.delete(priority_slots_key(code))
+    pipe.delete(queue_key(code))
+    pipe.delete(blocks_key(code))
+    pipe.delete(outbox_key(code))
+    pipe.delete(instance_key(code))
+    pipe.delete(eta_key(code))
+    pipe.delete(*placement_keys(code))
+    await pipe.execute()
+
+    # The provider index lives in another slot, so it is updated in a second step
+    pipe = rdb.pipeline(transaction=False)
+    if info:
+        queue_index.remove_from_index(pipe, info["service_provider_id"], info)
+    pipe.publish(QUEUE_INVALIDATION_CHANNEL, code)
+    await pipe.execute()
+    forget_queue(code)
+    await append_event(rdb, "delete", code)
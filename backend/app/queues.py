@@ -1,6 +1,6 @@
 import uuid
-from typing import Optional
-from pydantic import BaseModel
+from typing import Literal, Optional
+from pydantic import BaseModel, Field
 from pydantic_redis import Model
 from app.identities import PartyInfo
     
@@ -26,6 +26,9 @@ class QueueInfo(BaseModel):
     is_open: Optional[bool] = True
     max_block_capacity: Optional[int] = 100  # max number of people per block per queue, -1 for single file
     max_party_capacity: Optional[int] = 10 # max number of people per party per queue
+    max_priority_slots: Optional[int] = 0  # seats per block reserved for priority parties, 0 to disable
+    packing_policy: Optional[Literal["first_fit", "best_fit", "lookahead"]] = "first_fit"  # how joins pick a block
+    lookahead_window: Optional[int] = Field(4, ge=1)  # blocks "lookahead" considers past the earliest fit
     size: Optional[int] = 0  # current number of people in the queue
     wait_time_estimate: Optional[str] = "0 min"  # e.g. "15 min"
     manual_dispatch: Optional[bool] = False  # if True, blocks are dispatched manually
@@ -45,12 +48,17 @@ class QueueInfoRedis(Model):
     __key_prefix__ = "queue"
 
 class QueueStatus(BaseModel):
-    size: int
-    wait_time_estimate: str
-    name: str
-    description: str
+    size: int  # number of people waiting
+    parties: int = 0  # number of parties waiting
+    wait_time_estimate: Optional[str] = None
+    name: Optional[str] = None
+    description: Optional[str] = None
     block_count: int
-    image_url: str
+    serving_block: Optional[int] = None  # sequence number of the next block to dispatch
+    wait_seconds: Optional[int] = None  # estimated wait for a party joining now
+    party_block: Optional[int] = None  # caller's block, if they are in the queue
+    party_eta_seconds: Optional[int] = None  # caller's estimated wait
+    image_url: Optional[str] = None
 
     def to_dict(self):
         return self.model_dump()
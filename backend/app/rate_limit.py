@@ -0,0 +1,159 @@
+import os
+import math
+from typing import Optional
+from fastapi import Depends, HTTPException, Request
+from redis.asyncio import Redis
+from app.db import get_redis
+from app.auth.manager import get_claims
+from app.keys import rate_limit_key
+from app.metrics import RATE_LIMITED
+from app.utils import normalize_phone, normalize_email
+
+"""
+Token-bucket rate limits, checked in Redis before a route does any work.
+
+Each rule lists the buckets a request draws one token from, by scope:
+
+    ip      client address (RATE_LIMIT_IP_HEADER names a header set by a
+            trusted proxy, otherwise the socket peer), see below
+    phone   `phone` of the JSON body, normalized
+    email   `email` of the JSON body, normalized
+    caller  the authenticated subject: a party's phone or a provider's id
+    code    the `code` path parameter
+
+A bucket holds up to `capacity` tokens and refills `capacity` every
+`seconds`. Limits are set per rule and scope as RATE_LIMIT_<RULE>_<SCOPE>
+= "capacity/seconds", or "off"; RATE_LIMIT_ENABLED=false turns every
+rule off. One script checks all of a request's
+buckets and takes a token from each only if every one has one, so a
+request is never charged for a rejection. That is one round trip, spent in
+a dependency before bcrypt, SMS or placement runs. Rejections get a 429
+with Retry-After.
+
+Limits key on who is asking (phone, email, caller) rather than where from.
+A venue's Wi-Fi, a carrier NAT or the load balancer in front of the API
+puts a whole crowd behind one address, so per-address limits would make
+everyone in the room share one bucket. They are off by default, except
+for provider registration, which has nothing else to key on and gets a
+loose one. Enable them per rule with RATE_LIMIT_<RULE>_IP, and behind a
+proxy set RATE_LIMIT_IP_HEADER to the header it overwrites with the
+client address (e.g. X-Forwarded-For), or every request counts against
+the proxy's own address.
+"""
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_IP_HEADER = os.getenv("RATE_LIMIT_IP_HEADER")  # e.g. X-Forwarded-For behind a proxy that overwrites it
+
+TOKEN_BUCKET_LUA = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local levels = {}
+local retry, denied = 0, 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    local bucket = redis.call('HMGET', key, 'tokens', 'at')
+    local tokens = capacity
+    if bucket[1] then
+        tokens = math.min(capacity, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * rate)
+    end
+    levels[i] = tokens
+    if tokens < 1 and (1 - tokens) / rate > retry then
+        retry, denied = (1 - tokens) / rate, i
+    end
+end
+if denied > 0 then
+    return {math.ceil(retry * 1000), denied}
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    redis.call('HSET', key, 'tokens', levels[i] - 1, 'at', now)
+    -- A full bucket is the same as no bucket
+    redis.call('EXPIRE', key, math.ceil(capacity / rate))
+end
+return {0, 0}
+"""
+
+def limit(rule: str, scope: str, default: str) -> Optional[tuple[int, float]]:
+    value = os.getenv(f"RATE_LIMIT_{rule.upper()}_{scope.upper()}", default)
+    if value == "off":
+        return None
+    capacity, seconds = value.split("/")
+    return int(capacity), float(seconds)
+
+def rules(rule: str, **defaults: str) -> dict:
+    limits = {scope: limit(rule, scope, default) for scope, default in defaults.items()}
+    return {scope: value for scope, value in limits.items() if value is not None}
+
+RATE_LIMITS = {
+    "login": rules("login", ip="off", phone="3/300"),  # every call sends an SMS
+    "verify": rules("verify", ip="off", phone="10/300"),  # OTP guesses
+    "provider_login": rules("provider_login", ip="off", email="10/300"),
+    "provider_register": rules("provider_register", ip="50/3600"),
+    "join": rules("join", ip="off", caller="10/60", code="600/60"),
+    "join_batch": rules("join_batch", caller="30/60", code="600/60"),
+}
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_IP_HEADER:
+        forwarded = request.headers.get(RATE_LIMIT_IP_HEADER)
+        if forwarded:
+            return forwarded.split(",", 1)[0].strip()
+    return request.client.host if request.client else "unknown"
+
+async def body_field(request: Request, field: str, normalize) -> Optional[str]:
+    # FastAPI has already read and parsed the body, this is the cached copy.
+    # A missing or malformed value fails the route's own validation, no bucket for it.
+    try:
+        return normalize((await request.json())[field])
+    except Exception:
+        return None
+
+async def identities(request: Request, scopes, claims: Optional[dict]) -> dict:
+    found = {}
+    for scope in scopes:
+        if scope == "ip":
+            found[scope] = client_ip(request)
+        elif scope == "phone":
+            found[scope] = await body_field(request, "phone", normalize_phone)
+        elif scope == "email":
+            found[scope] = await body_field(request, "email", normalize_email)
+        elif scope == "caller":
+            found[scope] = claims["sub"] if claims else None
+        elif scope == "code":
+            found[scope] = request.path_params.get("code")
+    return {scope: identity for scope, identity in found.items() if identity}
+
+async def enforce(rdb: Redis, rule: str, found: dict):
+    limits = RATE_LIMITS[rule]
+    scopes = [scope for scope in limits if scope in found]
+    if not RATE_LIMIT_ENABLED or not scopes:
+        return
+    keys, args = [], []
+    for scope in scopes:
+        capacity, seconds = limits[scope]
+        keys.append(rate_limit_key(rule, scope, found[scope]))
+        args.extend([capacity, capacity / seconds])
+    script = rdb.register_script(TOKEN_BUCKET_LUA)
+    retry_ms, denied = await script(keys=keys, args=args)
+    if denied:
+        scope = scopes[int(denied) - 1]
+        RATE_LIMITED.labels(rule, scope).inc()
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests, try again later",
+            headers={"Retry-After": str(max(math.ceil(int(retry_ms) / 1000), 1))},
+        )
+
+"""Dependency enforcing RATE_LIMITS[rule], 429 once any of its buckets is empty"""
+def rate_limit(rule: str):
+    scopes = tuple(RATE_LIMITS[rule])
+    if "caller" in scopes:
+        async def check_caller(request: Request, claims: dict = Depends(get_claims), rdb: Redis = Depends(get_redis)):
+            await enforce(rdb, rule, await identities(request, scopes, claims))
+        return check_caller
+
+    async def check(request: Request, rdb: Redis = Depends(get_redis)):
+        await enforce(rdb, rule, await identities(request, scopes, None))
+    return check
@@ -8,7 +8,7 @@ class Response(BaseModel):
 
 class JoinQueueResponse(BaseModel):
     status_code: int
-    body: PartyInfo  # or a more specific model like PartyInfo
+    body: dict  # e.g. {"phone": "+1234567890", "block_id": "ABC123-1"}
 
 class QueueStatusResponse(BaseModel):
     status_code: int
@@ -1,7 +1,9 @@
-import json
-from fastapi import APIRouter, Path, HTTPException
+import os
+import logging
+from fastapi import APIRouter, Path, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer
-from redis import Redis
+from redis.asyncio import Redis
 from fastapi import Depends, Query
 from fastapi.security import HTTPBearer
 from app.db import get_db, get_redis
@@ -9,46 +11,150 @@ from app.models import Party, ServiceProvider
 from app.responses import Response
 from app.identities import PartyInfo, ServiceProviderInfo
 from app.queues import QueueInfo
-from app import queue_manager
+from app import queue_manager, queue_index, dispatch
 from app.responses import JoinQueueResponse, QueueStatusResponse, Response
 from app.responses import QueueInfoResponse, QueueListResponse
-from app.utils import generate_code, sanitize_str
-from sqlalchemy.orm import Session
-from app.auth.manager import get_token, parse_token, hash_password
+from app.utils import generate_code, normalize_phone
+from app.queue_info import IMMUTABLE_FIELDS, get_infos, complete_info
+from app.codec import ORJSONResponse, dumps_str
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.auth.manager import get_claims, hash_password, verify_jwt
+from app.notifier import QueueNotifier, get_notifier, watch_queue
+from app.queue_cache import QueueMeta, get_queue_meta, get_fresh_queue_meta
+from app.rate_limit import rate_limit
 from typing import Optional
 
 router = APIRouter()
 security = HTTPBearer()
 
+MAX_BATCH_JOIN = int(os.getenv("MAX_BATCH_JOIN", 500))  # parties per /queue/join/{code}/batch call
+
+def valid_phone(phone: str) -> Optional[str]:
+    try:
+        return normalize_phone(phone)
+    except Exception:
+        return None
+
 """
 User-facing
 """
-@router.post("/queue/join/{code}", response_model=JoinQueueResponse)
+@router.post("/queue/join/{code}", response_model=JoinQueueResponse, dependencies=[Depends(rate_limit("join"))])
 async def join_queue(
     code: str = Path(..., pattern="^[A-Z0-9]{6}$"),
     payload: PartyInfo = None,
-    token: str = Depends(get_token), 
+    claims: dict = Depends(get_claims), 
     rdb: Redis = Depends(get_redis)
 ):
     if payload is None:
         raise HTTPException(status_code=400, detail="Missing request body")
+    # Status, leave and the live feeds find the party by the phone its token was issued for
+    if valid_phone(payload.phone) != claims["sub"]:
+        raise HTTPException(status_code=403, detail="Forbidden: Cannot join the queue for another phone")
+    payload.phone = claims["sub"]
+    # Priority seats are handed out by the provider (batch join), never claimed by the party itself
+    payload.priority = 0
     try:
-        party_id, block_id = queue_manager.add_party_to_block(rdb, code, payload)
-        return JoinQueueResponse(status_code=200, body={"party_id": party_id, "block_id": block_id})
+        placement = await queue_manager.add_party_to_block(rdb, code, payload)
+        return ORJSONResponse({"status_code": 200, "body": placement})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        return JoinQueueResponse(status_code=500, body={"error": str(e)})
+        return ORJSONResponse({"status_code": 500, "body": {"error": str(e)}})
+
+
+@router.post("/queue/join/{code}/batch", response_model=JoinQueueResponse,
+             dependencies=[Depends(security), Depends(rate_limit("join_batch"))])
+async def join_queue_batch(
+    payload: list[PartyInfo],
+    code: str = Path(..., pattern="^[A-Z0-9]{6}$"),
+    claims: dict = Depends(get_claims),
+    queue: QueueMeta = Depends(get_queue_meta),
+    rdb: Redis = Depends(get_redis)
+):
+    # Kiosks and reservation imports act for the provider who owns the queue
+    if claims["sub"] != str(queue.owner):
+        raise HTTPException(status_code=403, detail="Forbidden: Cannot join parties to other service provider queues")
+    if not payload:
+        raise HTTPException(status_code=400, detail="Missing request body")
+    if len(payload) > MAX_BATCH_JOIN:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_JOIN} parties per batch")
+    # Stored under the normalized phone, which is what the parties' own tokens carry
+    results, parties = [], []
+    for party in payload:
+        phone = valid_phone(party.phone)
+        if phone is None:
+            results.append({"phone": party.phone, "error": "Invalid phone number"})
+        else:
+            parties.append(party.model_copy(update={"phone": phone}))
+            results.append(None)
+    placed = iter(await queue_manager.add_parties_to_blocks(rdb, code, parties) if parties else [])
+    results = [result or next(placed) for result in results]
+    placed = sum(1 for result in results if "block_id" in result)
+    return ORJSONResponse({"status_code": 200, "body": {"placed": placed, "failed": len(results) - placed, "results": results}})
+
+
+@router.post("/queue/leave/{code}", response_model=JoinQueueResponse)
+async def leave_queue(
+    code: str = Path(..., pattern="^[A-Z0-9]{6}$"),
+    claims: dict = Depends(get_claims),
+    rdb: Redis = Depends(get_redis)
+):
+    try:
+        placement = await queue_manager.remove_party_from_block(rdb, code, claims["sub"])
+        return ORJSONResponse({"status_code": 200, "body": placement})
+    except Exception as e:
+        return ORJSONResponse({"status_code": 500, "body": {"error": str(e)}})
 
 
 @router.get("/queue/status/{code}", response_model=QueueStatusResponse)
 async def status_queue(
-    payload: dict, 
     code: str = Path(..., pattern="^[A-Z0-9]{6}$"),
-    token: str = Depends(get_token)
+    claims: dict = Depends(get_claims),
+    rdb: Redis = Depends(get_redis)
 ):
-    # TODO: Implement status retrieval
-    return QueueStatusResponse(status_code=200, body={})
+    status = await queue_manager.get_status(rdb, code, claims["sub"])
+    if status is None:
+        raise HTTPException(status_code=404, detail="Queue not found")
+    return ORJSONResponse({"status_code": 200, "body": status.to_dict()})
 
 
+@router.get("/queue/events/{code}")
+async def queue_events(
+    code: str = Path(..., pattern="^[A-Z0-9]{6}$"),
+    claims: dict = Depends(get_claims),
+    rdb: Redis = Depends(get_redis),
+    notifier: QueueNotifier = Depends(get_notifier)
+):
+    # Server-Sent Events stream of queue changes and the caller's position
+    async def stream():
+        async for event in watch_queue(notifier, rdb, code, claims["sub"]):
+            if event is None:
+                yield ": ping\n\n"
+            else:
+                yield f"event: {event['type']}\ndata: {dumps_str(event)}\n\n"
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@router.websocket("/queue/ws/{code}")
+async def queue_websocket(
+    websocket: WebSocket,
+    code: str = Path(..., pattern="^[A-Z0-9]{6}$"),
+    token: str = Query(...),  # browsers cannot set headers on WebSocket upgrades
+    rdb: Redis = Depends(get_redis),
+    notifier: QueueNotifier = Depends(get_notifier)
+):
+    try:
+        claims = await verify_jwt(rdb, token)
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    try:
+        async for event in watch_queue(notifier, rdb, code, claims["sub"]):
+            await websocket.send_text(dumps_str(event if event is not None else {"type": "ping"}))
+    except WebSocketDisconnect:
+        pass
+
 
 """
 ServiceProvider-facing
@@ -56,142 +162,102 @@ ServiceProvider-facing
 @router.post("/queue/create", response_model=Response, dependencies=[Depends(security)])
 async def create_queue(
     payload: QueueInfo,
-    token: str = Depends(get_token), 
+    claims: dict = Depends(get_claims), 
     rdb: Redis = Depends(get_redis),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    # Get the service provider
-    service_provider_id = int(parse_token(token)["sub"])
-    service_provider = db.get(ServiceProvider, service_provider_id)
-    if service_provider is None:
-        raise HTTPException(status_code=404, detail="Service provider not found")
-    
-    # Generate 6-digit alpha-numeric code associated with queue
-    payload.code = generate_code()
-    while rdb.exists(f"queue:{payload.code}"):
-        payload.code = generate_code()
-        
-    # Initialize the queue in Redis
+    service_provider_id = int(claims["sub"])
+
+    # Regular parties need at least one seat per block that isn't reserved
+    slots = payload.max_priority_slots or 0
+    capacity = payload.max_block_capacity
+    if slots < 0 or (capacity is not None and capacity >= 0 and slots >= capacity):
+        raise HTTPException(status_code=400, detail="max_priority_slots must be between 0 and max_block_capacity - 1")
+
+    # Claim a 6-digit alpha-numeric code associated with queue
+    payload.code = await queue_manager.allocate_code(rdb, service_provider_id)
     payload.service_provider_id = service_provider_id
-    queue_manager.initialize_queue(rdb, payload)
+    try:
+        # Add the queue code to the service provider's list of queues, which also checks they exist
+        provider_found = await queue_manager.add_provider_queue(db, service_provider_id, payload.code)
+    except BaseException:
+        await queue_manager.release_codes(rdb, [payload.code])
+        raise
+    if not provider_found:
+        await queue_manager.release_codes(rdb, [payload.code])
+        raise HTTPException(status_code=404, detail="Service provider not found")
 
-    # Add the queue code to the service provider's list of queues
-    service_provider.queue_codes.append(payload.code)
-    db.commit()
+    # Initialize the queue in Redis, and take it down again if Postgres never records it
+    try:
+        await queue_manager.initialize_queue(rdb, payload)
+        await db.commit()
+    except BaseException:
+        await queue_manager.delete_queue(rdb, payload.code)
+        raise
 
     return Response(status_code=200, body={"queue_code": payload.code})
 
-@router.get("/queue/{code}", response_model=QueueInfoResponse)
+@router.get("/queue/{code}", response_model=QueueInfoResponse, dependencies=[Depends(security)])
 async def get_queue(
     code: str = Path(..., pattern="^[A-Z0-9]{6}$"),
-    token: str = Depends(get_token),
+    # Declared first so unauthenticated callers can't probe which codes exist
+    claims: dict = Depends(get_claims),
+    queue: QueueMeta = Depends(get_queue_meta),
     rdb: Redis = Depends(get_redis)
 ):
-    # Ensure queue exists before attempting to delete
-    if not rdb.exists(f"queue:{code}"):
-        raise HTTPException(status_code=404, detail="Queue not found")
     # Ensure only service provider who owns queue can get it
-    id = rdb.get(f"queue:{code}:service_provider_id")
-    token_data = parse_token(token)
-    if token_data["sub"] != str(id):
+    if claims["sub"] != str(queue.owner):
         raise HTTPException(status_code=403, detail="Forbidden: Cannot get other service provider queues")
-    # Retrieve current queue info
-    queue_key = f"queue:{code}"
-    raw_data = rdb.lindex(queue_key, 0)
-    if not raw_data:
-        raise HTTPException(status_code=404, detail="Queue not found")
-    parsed_data = QueueInfo.from_dict(json.loads(raw_data))
-    return QueueInfoResponse(status_code=200, body=parsed_data)
+    [live] = await queue_manager.get_live_fields(rdb, [code])
+    return ORJSONResponse({"status_code": 200, "body": {**complete_info(queue.info), **live}})
 
 @router.get("/queues", response_model=QueueListResponse)
 async def get_queues(
     search: Optional[str] = Query(None),
     limit: int = Query(50, ge=1, le=100),
     offset: int = Query(0, ge=0),
-    token: str = Depends(get_token),
+    claims: dict = Depends(get_claims),
     rdb: Redis = Depends(get_redis),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    token_data = parse_token(token)
-    service_provider_id = int(token_data["sub"])
-
-    # Get the service provider queues
-    sp = db.get(ServiceProvider, service_provider_id)
-    if not sp:
-        raise HTTPException(status_code=404, detail="Service provider not found")
-    queue_codes = sp.queue_codes or []
-
-    matched_queues = []
+    service_provider_id = int(claims["sub"])
 
-    # Get queue data and owners
-    pipe = rdb.pipeline()
-    for code in queue_codes:
-        pipe.lindex(f"queue:{code}", 0)
-        pipe.get(f"queue:{code}:service_provider_id")
-    results = pipe.execute()
+    # Served from the per-provider index, see app/queue_index.py
+    total, codes, built = await queue_index.search_queues(rdb, service_provider_id, search, offset, limit)
+    if not built:
+        # Queues created before the index existed (or still in the untagged layout) get indexed on first listing
+        sp = await db.get(ServiceProvider, service_provider_id)
+        if not sp:
+            raise HTTPException(status_code=404, detail="Service provider not found")
+        if await queue_index.build_index(rdb, service_provider_id, sp.queue_codes or []):
+            total, codes, _ = await queue_index.search_queues(rdb, service_provider_id, search, offset, limit)
 
-    for i in range(0, len(results), 2):
-        raw_data, owner_id = results[i], results[i+1]
-        if not raw_data:
-            continue
-        try:
-            queue_data = json.loads(raw_data)
-        except json.JSONDecodeError:
-            continue
-        # Check ownership
-        if str(owner_id) != str(service_provider_id):
-            continue
-        # Apply search filter
-        if search:
-            normalized_search = sanitize_str(search).lower()
-            normalized_blob = sanitize_str(raw_data).lower()
-            if normalized_search not in normalized_blob:
-                continue
-        matched_queues.append(QueueInfo.from_dict(queue_data))
-
-    matched_queues.sort(key=lambda q: q.name.lower())
-    paginated = matched_queues[offset:offset + limit]
-    return QueueListResponse(
-        status_code=200, 
-        body=paginated,
-        total=len(matched_queues),
-        limit=limit,
-        offset=offset
-    )
+    infos, live = await get_infos(rdb, codes), await queue_manager.get_live_fields(rdb, codes)
+    paginated = [{**complete_info(info), **fields} for info, fields in zip(infos, live) if info]
+    return ORJSONResponse({"status_code": 200, "total": total, "body": paginated, "limit": limit, "offset": offset})
 
 @router.patch("/queue/update/{code}", response_model=Response, dependencies=[Depends(security)])
 async def update_queue(
     payload: QueueInfo,
     code: str = Path(..., pattern="^[A-Z0-9]{6}$"),
-    token: str = Depends(get_token),
+    claims: dict = Depends(get_claims),
+    queue: QueueMeta = Depends(get_fresh_queue_meta),
     rdb: Redis = Depends(get_redis)
 ):
-    # Ensure queue exists before attempting to delete
-    if not rdb.exists(f"queue:{code}"):
-        raise HTTPException(status_code=404, detail="Queue not found")
     # Ensure only service provider who owns queue can update it
-    id = rdb.get(f"queue:{code}:service_provider_id")
-    token_data = parse_token(token)
-    if token_data["sub"] != str(id):
+    if claims["sub"] != str(queue.owner):
         raise HTTPException(status_code=403, detail="Forbidden: Cannot update other service provider queues")
-    # Retrieve current queue info
-    queue_key = f"queue:{code}"
-    raw_data = rdb.lindex(queue_key, 0)
-    if not raw_data:
-        raise HTTPException(status_code=404, detail="Queue not found")
-    current_data = json.loads(raw_data)
-    # Merge with incoming payload
-    updated_data = current_data.copy()
-    for key, value in payload.to_dict().items():
-        if value is not None:
-            if key == "capacity" and value != current_data.get("capacity"):
-                raise HTTPException(
-                    status_code=400,
-                    detail="Cannot update 'capacity'. Create a new queue instead."
-                )
-            updated_data[key] = value
-    # Overwrite Redis entry
-    rdb.lset(queue_key, 0, json.dumps(updated_data))
+    current_data = queue.info
+    # Only the fields the request sent, unset ones keep whatever is stored
+    changes = {key: value for key, value in payload.model_dump(exclude_unset=True).items() if value is not None}
+    for key in IMMUTABLE_FIELDS:
+        if key in changes and changes[key] != current_data.get(key):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Cannot update '{key}'. Create a new queue instead."
+            )
+    # Write the changed fields and move the queue in the provider's index
+    await queue_manager.update_queue(rdb, code, current_data, changes)
     return Response(status_code=204)
 
 
@@ -199,51 +265,57 @@ async def update_queue(
 async def delete_queue(
     payload: QueueInfo,
     code: str = Path(..., pattern="^[A-Z0-9]{6}$"),
-    token: str = Depends(get_token), 
+    claims: dict = Depends(get_claims),
+    queue: QueueMeta = Depends(get_fresh_queue_meta),
     rdb: Redis = Depends(get_redis),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    # Ensure queue exists before attempting to delete
-    if not rdb.exists(f"queue:{code}"):
-        raise HTTPException(status_code=404, detail="Queue not found")
     # Add auth to ensure only service provider who owns queue can delete it
-    id = rdb.get(f"queue:{code}:service_provider_id")
-    token_data = parse_token(token)
-    if token_data["sub"] != str(id):
+    if claims["sub"] != str(queue.owner):
         raise HTTPException(status_code=403, detail="Forbidden: Cannot delete other service provider queues")
     # Remove the code from the service provider's list of queues
-    sp = db.get(ServiceProvider, id)
+    sp = await db.get(ServiceProvider, int(queue.owner))
     if not sp:
         raise HTTPException(status_code=404, detail="Service provider not found")
     sp.queue_codes.remove(code)
+    await db.commit()
+    # Flush dispatched blocks that are not in Postgres yet before dropping the outbox
+    await dispatch.persist_dispatched(rdb, db, code, sp.id)
     # Delete the queue and all associated data
-    pipe = rdb.pipeline()
-    pipe.delete(f"queue:{code}:service_provider_id")
-    pipe.delete(f"queue:{code}:block_counter")
-    pipe.delete(f"queue:{code}:block_capacity")
-    pipe.delete(f"queue:{code}")
-    pipe.delete(f"blocks:{code}")
-    pipe.execute()
+    await queue_manager.delete_queue(rdb, code)
     return Response(status_code=204)
 
-@router.post("/queue/dispatch", response_model=Response, dependencies=[Depends(security)])
+@router.post("/queue/dispatch/{code}", response_model=Response, dependencies=[Depends(security)])
 async def dispatch_queue(
-    payload: QueueInfo,
     code: str = Path(..., pattern="^[A-Z0-9]{6}$"),
-    token: str = Depends(get_token), 
-    rdb: Redis = Depends(get_redis)
+    claims: dict = Depends(get_claims),
+    queue: QueueMeta = Depends(get_queue_meta),
+    rdb: Redis = Depends(get_redis),
+    db: AsyncSession = Depends(get_db)
 ):
+    # Ensure only service provider who owns queue can dispatch it
+    if claims["sub"] != str(queue.owner):
+        raise HTTPException(status_code=403, detail="Forbidden: Cannot dispatch other service provider queues")
     # Dispatch the current block in the queue
-    return Response(status_code=204)
+    block = await dispatch.dispatch_block(rdb, code)
+    # Also retries anything a previous dispatch failed to persist
+    try:
+        await dispatch.persist_dispatched(rdb, db, code, int(queue.owner), max_batches=1)
+    except Exception as e:
+        # The block stays in the outbox and is written on the next dispatch
+        logging.error(f"Failed to persist dispatched blocks for {code}: {e}")
+    if block is None:
+        return ORJSONResponse({"status_code": 204, "body": None})
+    return ORJSONResponse({"status_code": 200, "body": {"block_id": block["block_id"], "size": block["used"]}})
 
 @router.get("/provider/{id}", response_model=ServiceProviderInfo, dependencies=[Depends(security)])
 async def get_service_provider(
     id: int, 
-    token: str = Depends(get_token), 
-    db: Session = Depends(get_db)
+    claims: dict = Depends(get_claims), 
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        service_provider = db.get(ServiceProvider, id)
+        service_provider = await db.get(ServiceProvider, id)
     except Exception:
         raise HTTPException(status_code=404, detail=f"ServiceProvider {id} does not exist")
     return Response(status_code=200, body=service_provider)
@@ -251,32 +323,30 @@ async def get_service_provider(
 @router.post("/provider/delete/{id}", response_model=Response, dependencies=[Depends(security)])
 async def delete_service_provider(
     id: int, 
-    token: str = Depends(get_token), 
-    db: Session = Depends(get_db)
+    claims: dict = Depends(get_claims), 
+    db: AsyncSession = Depends(get_db)
 ):
-    token_data = parse_token(token)
-    if token_data["sub"] != str(id):
+    if claims["sub"] != str(id):
         raise HTTPException(status_code=403, detail="Forbidden: Cannot delete other service providers")
-    db.delete(db.get(ServiceProvider, id))
-    db.commit()
+    await db.delete(await db.get(ServiceProvider, id))
+    await db.commit()
     return Response(status_code=204)
 
 @router.patch("/provider/update/{id}", response_model=Response, dependencies=[Depends(security)])
 async def update_service_provider(
     id: int, 
     payload: ServiceProviderInfo,
-    token: str = Depends(get_token), 
-    db: Session = Depends(get_db)
+    claims: dict = Depends(get_claims), 
+    db: AsyncSession = Depends(get_db)
 ):
-    token_data = parse_token(token)
-    if token_data["sub"] != str(id):
+    if claims["sub"] != str(id):
         raise HTTPException(status_code=403, detail="Forbidden: Cannot update other service providers")
-    service_provider = db.get(ServiceProvider, id)
+    service_provider = await db.get(ServiceProvider, id)
     # TODO: Validate payload fields
     for key, value in payload.to_dict().items():
         if key != "hashed_password" and value is not None:
             setattr(service_provider, key, value)
         elif key == "hashed_password" and value is not None:
-            setattr(service_provider, key, hash_password(value))
-    db.commit()
+            setattr(service_provider, key, await hash_password(value))
+    await db.commit()
     return Response(status_code=204)
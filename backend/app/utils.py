@@ -3,11 +3,16 @@ import string
 import phonenumbers
 import re
 import html
+from datetime import datetime, timezone
 
 def generate_code():
     alphabet = string.ascii_uppercase + string.digits
     return ''.join(secrets.choice(alphabet) for _ in range(6))
 
+def utcnow() -> datetime:
+    # Naive UTC, which is what the DateTime columns (timestamp without time zone) hold
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 def normalize_email(email: str) -> str:
     return email.strip().lower()
 
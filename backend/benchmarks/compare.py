@@ -0,0 +1,62 @@
+import sys
+import json
+import argparse
+
+"""
+Compares two benchmark reports written by `python -m benchmarks.run --output`.
+
+    python -m benchmarks.compare baseline.json current.json --threshold 0.15
+
+Cases are matched on (scenario, concurrency, queue size). A case regresses
+when its latency percentile grows, or its throughput drops, by more than
+the threshold, or when it has errors the baseline didn't. Exits with 1 if
+any case regressed, so it can gate a release.
+"""
+
+def case_key(result: dict) -> tuple:
+    return result["scenario"], result["concurrency"], result["queue_size"]
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        report = json.load(f)
+    return {case_key(result): result for result in report["results"]}
+
+def change(old: float, new: float) -> float:
+    return (new - old) / old if old else 0.0
+
+def compare(baseline: dict, current: dict, percentile: str, threshold: float) -> tuple[list[str], int]:
+    lines, regressions = [], 0
+    for key in sorted(baseline.keys() & current.keys()):
+        old, new = baseline[key], current[key]
+        latency = change(old["latency_ms"][percentile], new["latency_ms"][percentile])
+        throughput = change(old["throughput_rps"] or 0, new["throughput_rps"] or 0)
+        problems = []
+        if latency > threshold:
+            problems.append(f"{percentile} +{latency:.0%}")
+        if throughput < -threshold:
+            problems.append(f"throughput {throughput:.0%}")
+        if new["errors"] > old["errors"]:
+            problems.append(f"errors {old['errors']} -> {new['errors']}")
+        regressions += bool(problems)
+        scenario, concurrency, queue_size = key
+        lines.append(
+            f"{scenario:<10} {concurrency:>5} {queue_size:>8} "
+            f"{old['latency_ms'][percentile]:>9} -> {new['latency_ms'][percentile]:<9} ({latency:+.0%}) "
+            f"{old['throughput_rps']:>10} -> {new['throughput_rps']:<10} ({throughput:+.0%})"
+            + (f"  REGRESSED: {', '.join(problems)}" if problems else "")
+        )
+    for key in sorted(baseline.keys() ^ current.keys()):
+        lines.append(f"{' '.join(map(str, key))}: only in {'baseline' if key in baseline else 'current'}")
+    return lines, regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.compare", description="Compare two benchmark reports")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--percentile", choices=["p50", "p95", "p99"], default="p95")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative change (default: 0.10)")
+    args = parser.parse_args()
+    lines, regressions = compare(load(args.baseline), load(args.current), args.percentile, args.threshold)
+    print("\n".join(lines))
+    print(f"{regressions} regressed case(s)")
+    sys.exit(1 if regressions else 0)
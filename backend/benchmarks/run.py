@@ -0,0 +1,155 @@
+import sys
+import json
+import math
+import time
+import asyncio
+import platform
+import argparse
+import subprocess
+from datetime import datetime, timezone
+from benchmarks import targets
+from benchmarks.scenarios import SCENARIOS, Bench, Operation
+
+"""
+HTTP benchmarks for the hot endpoints.
+
+    python -m benchmarks.run                                  # in-process, every scenario
+    python -m benchmarks.run --url http://localhost:8000 \\
+        --scenarios join,status --concurrency 1,16,64 --queue-size 0,10000 \\
+        --requests 2000 --output results.json
+
+Every scenario runs once per (concurrency, queue size) pair: setup, then
+`--warmup` untimed requests, then `--requests` timed ones issued by
+`concurrency` workers. Each result reports throughput and p50/p95/p99
+latency; `--output` writes them as JSON for `python -m benchmarks.compare`.
+See targets.py for what in-process numbers do and don't mean.
+"""
+
+SCHEMA_VERSION = 1
+
+def percentile(ordered: list[float], p: float) -> float:
+    # Nearest rank
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    millis = lambda seconds: round(seconds * 1000, 3)
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(ordered) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "min": millis(ordered[0]),
+            "mean": millis(sum(ordered) / len(ordered)),
+            "p50": millis(percentile(ordered, 50)),
+            "p95": millis(percentile(ordered, 95)),
+            "p99": millis(percentile(ordered, 99)),
+            "max": millis(ordered[-1]),
+        },
+    }
+
+async def drive(op: Operation, indices: range, concurrency: int) -> tuple[list[float], int, float]:
+    latencies = []
+    errors = 0
+    pending = iter(indices)
+
+    async def worker():
+        nonlocal errors
+        # Workers share one iterator, so each request number is issued exactly once
+        for i in pending:
+            start = time.perf_counter()
+            try:
+                ok = await op(i)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+async def run_case(bench: Bench, scenario: str, concurrency: int, queue_size: int, requests: int, warmup: int) -> dict:
+    op = await SCENARIOS[scenario](bench, queue_size, warmup + requests)
+    if warmup:
+        await drive(op, range(warmup), concurrency)
+    latencies, errors, elapsed = await drive(op, range(warmup, warmup + requests), concurrency)
+    return {"scenario": scenario, "concurrency": concurrency, "queue_size": queue_size,
+            **summarize(latencies, errors, elapsed)}
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def format_row(result: dict) -> str:
+    latency = result["latency_ms"]
+    return (f"{result['scenario']:<10} {result['concurrency']:>5} {result['queue_size']:>8} "
+            f"{result['throughput_rps']:>10} {latency['p50']:>9} {latency['p95']:>9} {latency['p99']:>9} "
+            f"{result['errors']:>7}")
+
+HEADER = f"{'scenario':<10} {'conc':>5} {'queue':>8} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}"
+
+def int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",") if item]
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Benchmark the hot API endpoints")
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma separated, any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 16], help="comma separated (default: 1,16)")
+    parser.add_argument("--queue-size", type=int_list, default=[0, 1000],
+                        help="parties already waiting, comma separated (default: 0,1000)")
+    parser.add_argument("--requests", type=int, default=500, help="timed requests per case (default: 500)")
+    parser.add_argument("--warmup", type=int, default=50, help="untimed requests before each case (default: 50)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--log-level", default="WARNING", help="app log level while benchmarking (default: WARNING)")
+    args = parser.parse_args(argv)
+    args.scenarios = [name for name in args.scenarios.split(",") if name]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    if args.requests < 1:
+        parser.error("--requests must be at least 1")
+    return args
+
+async def main(args: argparse.Namespace) -> dict:
+    if args.url:
+        target_context = targets.remote(args.url, max(args.concurrency))
+    else:
+        target_context = targets.in_process()
+    report = {
+        "schema": SCHEMA_VERSION,
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "target": args.url or "in-process",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"requests": args.requests, "warmup": args.warmup},
+        "results": [],
+    }
+    async with target_context as target:
+        targets.quiet_logging(args.log_level)
+        bench = Bench(target)
+        print(HEADER, file=sys.stderr)
+        for scenario in args.scenarios:
+            for queue_size in args.queue_size:
+                for concurrency in args.concurrency:
+                    result = await run_case(bench, scenario, concurrency, queue_size, args.requests, args.warmup)
+                    report["results"].append(result)
+                    print(format_row(result), file=sys.stderr)
+    return report
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,150 @@
+import random
+import uuid
+from typing import Awaitable, Callable
+import httpx
+from benchmarks.targets import Target
+from app.auth.manager import create_tokens, store_otp
+
+"""
+Benchmark scenarios, one per hot endpoint.
+
+Each scenario is an async setup function that prepares everything its
+requests need (a fresh provider, queues seeded with `queue_size` waiting
+parties, pre-minted tokens) and returns the operation to time. Operations
+take the request number and return whether the request succeeded; setup is
+never timed.
+"""
+
+BLOCK_CAPACITY = 10
+SEED_BATCH = 500  # parties per /queue/join/{code}/batch call, MAX_BATCH_JOIN on the server
+PROVIDER_QUEUES = 50  # queues the /queues scenario's provider owns, one full page
+STATUS_CALLERS = 200  # distinct parties polling /queue/status
+BENCH_PASSWORD = "bench-password"
+BENCH_OTP = "123456"
+
+Operation = Callable[[int], Awaitable[bool]]
+
+class Bench:
+    def __init__(self, target: Target):
+        self.target = target
+        self.client = target.client
+        self.rdb = target.rdb
+        # Random base so runs against the same databases don't collide on phone numbers
+        self.phone_base = random.randrange(8_000_000)
+        self.phones = 0
+
+    def next_phone(self) -> str:
+        # 202-2xx-xxxx is a valid US range, which normalize_phone insists on
+        self.phones += 1
+        return f"+1202{2_000_000 + (self.phone_base + self.phones) % 8_000_000}"
+
+    async def headers_for(self, id: str) -> dict:
+        access_token, _ = await create_tokens(id, self.rdb)
+        return {"Authorization": f"Bearer {access_token}"}
+
+def succeeded(response: httpx.Response) -> bool:
+    if response.status_code >= 400:
+        return False
+    if response.status_code == 204 or not response.content:
+        return True
+    # Some routes report failures in the body's status_code with HTTP 200
+    body = response.json()
+    return not (isinstance(body, dict) and body.get("status_code", 200) >= 400)
+
+def expect(response: httpx.Response) -> dict:
+    if not succeeded(response):
+        raise RuntimeError(f"{response.request.method} {response.request.url.path} failed during setup: "
+                           f"{response.status_code} {response.text}")
+    return response.json() if response.content else {}
+
+async def register_provider(bench: Bench) -> dict:
+    email = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+    expect(await bench.client.post("/auth/provider/register", json={
+        "name": "Benchmark", "email": email, "password": BENCH_PASSWORD, "location": "Benchmark"}))
+    body = expect(await bench.client.post("/auth/provider/login", json={"email": email, "password": BENCH_PASSWORD}))
+    return {"Authorization": f"Bearer {body['body']['access_token']}"}
+
+async def create_queue(bench: Bench, headers: dict, queue_size: int, name: str = "Benchmark queue") -> str:
+    body = expect(await bench.client.post("/queue/create", headers=headers, json={
+        "name": name, "description": "Benchmark", "max_block_capacity": BLOCK_CAPACITY}))
+    code = body["body"]["queue_code"]
+    await seed_parties(bench, headers, code, [bench.next_phone() for _ in range(queue_size)])
+    return code
+
+async def seed_parties(bench: Bench, headers: dict, code: str, phones: list[str]):
+    for i in range(0, len(phones), SEED_BATCH):
+        parties = [{"phone": phone, "name": "Seed"} for phone in phones[i:i + SEED_BATCH]]
+        body = expect(await bench.client.post(f"/queue/join/{code}/batch", headers=headers, json=parties))
+        if body["body"]["failed"]:
+            raise RuntimeError(f"Seeding {code} failed: {body['body']}")
+
+async def setup_join(bench: Bench, queue_size: int, total: int) -> Operation:
+    code = await create_queue(bench, await register_provider(bench), queue_size)
+    phones = [bench.next_phone() for _ in range(total)]
+    headers = [await bench.headers_for(phone) for phone in phones]
+
+    async def join(i: int) -> bool:
+        response = await bench.client.post(f"/queue/join/{code}", headers=headers[i],
+                                           json={"phone": phones[i], "name": "Party", "party_size": 1})
+        return succeeded(response)
+    return join
+
+async def setup_status(bench: Bench, queue_size: int, total: int) -> Operation:
+    provider = await register_provider(bench)
+    code = await create_queue(bench, provider, 0)
+    callers = [bench.next_phone() for _ in range(STATUS_CALLERS)]
+    # Callers are waiting at the head of the queue (when queue_size allows), so the party lookup is exercised too
+    await seed_parties(bench, provider, code, callers[:queue_size])
+    await seed_parties(bench, provider, code, [bench.next_phone() for _ in range(max(queue_size - STATUS_CALLERS, 0))])
+    headers = [await bench.headers_for(phone) for phone in callers]
+
+    async def status(i: int) -> bool:
+        return succeeded(await bench.client.get(f"/queue/status/{code}", headers=headers[i % len(headers)]))
+    return status
+
+async def setup_queue(bench: Bench, queue_size: int, total: int) -> Operation:
+    provider = await register_provider(bench)
+    code = await create_queue(bench, provider, queue_size)
+
+    async def queue(i: int) -> bool:
+        return succeeded(await bench.client.get(f"/queue/{code}", headers=provider))
+    return queue
+
+async def setup_queues(bench: Bench, queue_size: int, total: int) -> Operation:
+    provider = await register_provider(bench)
+    for n in range(PROVIDER_QUEUES):
+        await create_queue(bench, provider, queue_size, name=f"Benchmark queue {n:03d}")
+
+    async def queues(i: int) -> bool:
+        return succeeded(await bench.client.get("/queues", headers=provider, params={"limit": PROVIDER_QUEUES}))
+    return queues
+
+async def setup_auth(bench: Bench, queue_size: int, total: int) -> Operation:
+    phones = [bench.next_phone() for _ in range(total)]
+
+    async def login_verify(i: int) -> bool:
+        party = {"phone": phones[i], "name": "Party"}
+        if not succeeded(await bench.client.post("/auth/login", json=party)):
+            return False
+        # The OTP only goes out by SMS, so overwrite it with a known one (a single SETEX)
+        await store_otp(bench.rdb, phones[i], BENCH_OTP)
+        return succeeded(await bench.client.post("/auth/verify", json={**party, "otp": BENCH_OTP}))
+    return login_verify
+
+async def setup_dispatch(bench: Bench, queue_size: int, total: int) -> Operation:
+    # Enough full blocks that every request dispatches one and queue_size parties remain
+    provider = await register_provider(bench)
+    code = await create_queue(bench, provider, queue_size + total * BLOCK_CAPACITY)
+
+    async def dispatch(i: int) -> bool:
+        return succeeded(await bench.client.post(f"/queue/dispatch/{code}", headers=provider))
+    return dispatch
+
+SCENARIOS = {
+    "join": setup_join,
+    "status": setup_status,
+    "queue": setup_queue,
+    "queues": setup_queues,
+    "auth": setup_auth,
+    "dispatch": setup_dispatch,
+}
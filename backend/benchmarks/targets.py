@@ -0,0 +1,101 @@
+import os
+import asyncio
+import logging
+import tempfile
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+import httpx
+
+"""
+Where the benchmarks send their requests.
+
+`in_process` runs the FastAPI app inside the benchmark's event loop through
+httpx's ASGI transport, with fakeredis (Lua scripts run by lupa) standing
+in for Redis and SQLite (aiosqlite) for Postgres. No sockets or containers
+are involved, so its numbers are only comparable with other in-process
+runs: they show what a change does to the app's own work, not what a
+deployment can serve.
+
+`remote` sends real HTTP to a running server, e.g. the docker-compose
+stack. There is no SMS provider to read OTPs from, so the benchmark talks
+to the server's Redis directly to mint tokens and plant OTPs: REDIS_HOST,
+REDIS_PORT, JWT_SECRET and OTP_SECRET must match the server's (the app
+loads them from .env). Start the server with RATE_LIMIT_ENABLED=false or
+limits raised to the load. Run it against disposable databases, every run
+registers a provider and creates queues it never deletes.
+"""
+
+FAKE_POLL_SECONDS = 0.1  # fakeredis ignores XREADGROUP BLOCK, see in_process
+
+# app.db builds its Postgres URL at import; the benchmark process itself never connects to it
+for var, default in (("POSTGRES_USER", "bench"), ("POSTGRES_PASSWORD", "bench"), ("POSTGRES_HOST", "localhost"),
+                     ("POSTGRES_PORT", "5432"), ("POSTGRES_DB", "bench")):
+    os.environ.setdefault(var, default)
+# One client hammering one queue from one address is exactly what the rate limits stop
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+class Target:
+    def __init__(self, name: str, client: httpx.AsyncClient, rdb):
+        self.name = name
+        self.client = client
+        self.rdb = rdb
+
+@asynccontextmanager
+async def in_process() -> AsyncIterator[Target]:
+    import fakeredis
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+    from app import db, main, event_log
+    from app.models import Base
+    from app.metrics import instrument_engine
+
+    server = fakeredis.FakeServer()
+    # A file rather than :memory:, which would give every pooled connection its own empty database
+    tmpdir = tempfile.TemporaryDirectory(prefix="vqueue-bench-")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmpdir.name}/bench.db", connect_args={"timeout": 30})
+    instrument_engine(engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+    read_new = event_log.read_new
+    async def poll_new(rdb, consumer):
+        # Without BLOCK the event writer would spin on an empty stream and skew every timing
+        entries = await read_new(rdb, consumer)
+        if not entries:
+            await asyncio.sleep(FAKE_POLL_SECONDS)
+        return entries
+
+    # Swapped for the run and put back after, so repeated runs (test fixtures) don't stack wrappers
+    patched = [(event_log, "read_new"), (main, "create_redis"), (db, "SessionLocal"), (main, "SessionLocal"), (main, "engine")]
+    originals = [getattr(module, name) for module, name in patched]
+    event_log.read_new = poll_new
+    main.create_redis = lambda: fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+    db.SessionLocal = main.SessionLocal = session_factory
+    main.engine = engine
+
+    rdb = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+    transport = httpx.ASGITransport(app=main.app)
+    try:
+        async with main.app.router.lifespan_context(main.app):
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                yield Target("in-process", client, rdb)
+    finally:
+        for (module, name), original in zip(patched, originals):
+            setattr(module, name, original)
+        await rdb.aclose()
+        await engine.dispose()
+        tmpdir.cleanup()
+
+@asynccontextmanager
+async def remote(url: str, max_connections: int) -> AsyncIterator[Target]:
+    from app.db import create_redis
+
+    rdb = create_redis()
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        yield Target(url, client, rdb)
+    await rdb.aclose()
+
+def quiet_logging(level: str):
+    # httpx logs every request at INFO, the app's own default level
+    logging.getLogger().setLevel(level.upper())
@@ -0,0 +1,26 @@
+import pytest
+import fakeredis
+# Sets the environment app.db needs at import, before any test module imports the app
+from benchmarks import targets
+
+"""
+Shared fixtures. Async tests run on asyncio through anyio's pytest plugin
+(`pytest.mark.anyio`), against fakeredis with lupa running the Lua scripts,
+so the placement and dispatch scripts are exercised as they are in Redis.
+"""
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture
+async def rdb():
+    rdb = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    yield rdb
+    await rdb.aclose()
+
+@pytest.fixture
+async def target():
+    # The whole app in process, see benchmarks/targets.py
+    async with targets.in_process() as target:
+        yield target
@@ -0,0 +1,96 @@
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from app import dispatch, queue_manager
+from app.identities import PartyInfo
+from app.keys import blocks_key, outbox_key, parties_key, status_key
+from app.models import Base, Block, Party, ServiceProvider
+from app.queues import QueueInfo
+
+pytestmark = pytest.mark.anyio
+
+CODE = "TEST01"
+
+@pytest.fixture
+async def db(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/test.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)() as session:
+        session.add(ServiceProvider(id=1, name="Provider", email="provider@example.com", hashed_password="x"))
+        await session.commit()
+        yield session
+    await engine.dispose()
+
+async def create_queue(rdb, phones: list[str]):
+    await queue_manager.initialize_queue(rdb, QueueInfo(code=CODE, service_provider_id=1, name="Test", max_block_capacity=2))
+    await queue_manager.add_parties_to_blocks(rdb, CODE, [PartyInfo(phone=phone, name="Party") for phone in phones])
+
+async def test_dispatch_pops_head_block(rdb):
+    await create_queue(rdb, ["+12025550001", "+12025550002", "+12025550003"])
+    block = await dispatch.dispatch_block(rdb, CODE)
+    assert (block["block_id"], block["used"]) == (f"{CODE}-1", 2)
+    assert await rdb.lrange(blocks_key(CODE), 0, -1) == ["2"]
+    assert await rdb.hkeys(parties_key(CODE)) == ["+12025550003"]
+    status = await rdb.hgetall(status_key(CODE))
+    assert (status["size"], status["parties"], status["block_count"], status["serving_block"]) == ("1", "1", "1", "2")
+    assert await rdb.llen(outbox_key(CODE)) == 1
+
+async def test_dispatch_of_empty_queue(rdb):
+    await create_queue(rdb, [])
+    assert await dispatch.dispatch_block(rdb, CODE) is None
+
+async def test_flush_persists_blocks_and_parties(rdb, db):
+    await create_queue(rdb, ["+12025550001", "+12025550002", "+12025550003"])
+    await dispatch.dispatch_block(rdb, CODE)
+    await dispatch.dispatch_block(rdb, CODE)
+    assert await dispatch.persist_dispatched(rdb, db, CODE, 1) == 2
+    assert await rdb.llen(outbox_key(CODE)) == 0
+    blocks = (await db.execute(select(Block).order_by(Block.dispatched_at, Block.id))).scalars().all()
+    assert [block.id.split(".")[0] for block in blocks] == [f"{CODE}-1", f"{CODE}-2"]
+    assert all(block.status == "dispatched" and block.queue_code == CODE for block in blocks)
+    party = await db.get(Party, "+12025550003")
+    assert party.block_id == blocks[1].id
+
+async def test_flush_retry_is_harmless(rdb, db):
+    await create_queue(rdb, ["+12025550001"])
+    await dispatch.dispatch_block(rdb, CODE)
+    entries = await rdb.lrange(outbox_key(CODE), 0, -1)
+    await dispatch.persist_dispatched(rdb, db, CODE, 1)
+    # As if the process died after the commit but before trimming the outbox
+    await rdb.rpush(outbox_key(CODE), *entries)
+    assert await dispatch.persist_dispatched(rdb, db, CODE, 1) == 1
+    assert len((await db.execute(select(Block))).scalars().all()) == 1
+
+async def test_reused_code_keeps_history(rdb, db):
+    await create_queue(rdb, ["+12025550001"])
+    await dispatch.dispatch_block(rdb, CODE)
+    await dispatch.persist_dispatched(rdb, db, CODE, 1)
+    await queue_manager.delete_queue(rdb, CODE)
+    await create_queue(rdb, ["+12025550002"])
+    await dispatch.dispatch_block(rdb, CODE)
+    await dispatch.persist_dispatched(rdb, db, CODE, 1)
+    blocks = (await db.execute(select(Block))).scalars().all()
+    assert len(blocks) == 2
+    assert {(await db.get(Party, phone)).block_id for phone in ("+12025550001", "+12025550002")} == {b.id for b in blocks}
+
+async def test_flush_lock_is_only_released_by_its_owner(rdb, db):
+    await create_queue(rdb, ["+12025550001"])
+    await dispatch.dispatch_block(rdb, CODE)
+    lock_key = f"{outbox_key(CODE)}:lock"
+    await rdb.set(lock_key, "other-flusher")
+    assert await dispatch.persist_dispatched(rdb, db, CODE, 1) == 0
+    assert await rdb.get(lock_key) == "other-flusher"
+    await rdb.delete(lock_key)
+    assert await dispatch.persist_dispatched(rdb, db, CODE, 1) == 1
+    assert not await rdb.exists(lock_key)
+
+async def test_flush_can_be_capped_at_one_batch(rdb, db, monkeypatch):
+    monkeypatch.setattr(dispatch, "PERSIST_BATCH", 2)
+    await create_queue(rdb, [f"+1202555{i:04d}" for i in range(10)])
+    for _ in range(5):
+        await dispatch.dispatch_block(rdb, CODE)
+    assert await dispatch.persist_dispatched(rdb, db, CODE, 1, max_batches=1) == 2
+    assert await rdb.llen(outbox_key(CODE)) == 3
+    assert await dispatch.persist_dispatched(rdb, db, CODE, 1) == 3
+    assert await rdb.llen(outbox_key(CODE)) == 0
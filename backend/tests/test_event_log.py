@@ -0,0 +1,28 @@
+import pytest
+from app import event_log
+from app.event_log import EVENT_STREAM, EVENT_GROUP, EVENT_DEAD_LETTER_STREAM
+
+pytestmark = pytest.mark.anyio
+
+CONSUMER = "test-consumer"
+
+async def deliver(rdb, times: int):
+    await event_log.ensure_group(rdb)
+    await event_log.append_event(rdb, "join", "TEST01", phone="+12025550001")
+    await rdb.xreadgroup(EVENT_GROUP, CONSUMER, {EVENT_STREAM: ">"})
+    for _ in range(times - 1):
+        await rdb.xreadgroup(EVENT_GROUP, CONSUMER, {EVENT_STREAM: "0"})
+
+async def test_backlog_is_retried(rdb):
+    await deliver(rdb, 1)
+    [(entry_id, fields)] = await event_log.read_backlog(rdb, CONSUMER)
+    assert fields["type"] == "join"
+    assert await rdb.xlen(EVENT_DEAD_LETTER_STREAM) == 0
+
+async def test_exhausted_entries_are_dead_lettered(rdb):
+    await deliver(rdb, event_log.EVENT_MAX_DELIVERIES)
+    assert await event_log.read_backlog(rdb, CONSUMER) == []
+    [(_, fields)] = await rdb.xrange(EVENT_DEAD_LETTER_STREAM)
+    assert (fields["type"], fields["phone"]) == ("join", "+12025550001")
+    assert "entry_id" in fields
+    assert (await rdb.xpending(EVENT_STREAM, EVENT_GROUP))["pending"] == 0
@@ -0,0 +1,145 @@
+import pytest
+from pydantic import ValidationError
+from redis.exceptions import ResponseError
+from app import queue_manager
+from app.identities import PartyInfo
+from app.keys import block_key, parties_key, status_key
+from app.placement import place_parties, remove_party
+from app.queues import QueueInfo
+
+pytestmark = pytest.mark.anyio
+
+CODE = "TEST01"
+
+async def create_queue(rdb, capacity: int = 10, slots: int = 0, policy: str = "first_fit"):
+    await queue_manager.initialize_queue(rdb, QueueInfo(
+        code=CODE, service_provider_id=1, name="Test", max_block_capacity=capacity,
+        max_priority_slots=slots, packing_policy=policy))
+
+async def join(rdb, phone: str, size: int = 1, priority: int = 0) -> dict:
+    [placement] = await queue_manager.add_parties_to_blocks(rdb, CODE, [
+        PartyInfo.model_construct(phone=phone, name="Party", party_size=size, priority=priority)])
+    return placement
+
+async def block_state(rdb, seq) -> dict:
+    return await rdb.hgetall(block_key(CODE, seq))
+
+async def test_parties_fill_blocks_in_order(rdb):
+    await create_queue(rdb, capacity=4)
+    placements = [await join(rdb, f"+1202555{i:04d}", size=2) for i in range(5)]
+    assert [p["block_id"] for p in placements] == [f"{CODE}-1"] * 2 + [f"{CODE}-2"] * 2 + [f"{CODE}-3"]
+    status = await rdb.hgetall(status_key(CODE))
+    assert (status["size"], status["parties"], status["block_count"]) == ("10", "5", "3")
+
+async def test_first_fit_backfills_earlier_block(rdb):
+    await create_queue(rdb, capacity=4)
+    await join(rdb, "+12025550001", size=3)
+    await join(rdb, "+12025550002", size=3)
+    assert (await join(rdb, "+12025550003", size=1))["block_id"] == f"{CODE}-1"
+
+async def test_best_fit_takes_tightest_block(rdb):
+    await create_queue(rdb, capacity=4, policy="best_fit")
+    await join(rdb, "+12025550001", size=1)
+    await join(rdb, "+12025550002", size=3)
+    await join(rdb, "+12025550003", size=2)
+    # Block 1 has 1 seat left and block 2 has 2, so best_fit skips block 1
+    assert (await join(rdb, "+12025550004", size=2))["block_id"] == f"{CODE}-2"
+
+async def test_duplicate_party_rejected(rdb):
+    await create_queue(rdb)
+    await join(rdb, "+12025550001")
+    assert (await join(rdb, "+12025550001"))["error"] == "Party already in queue"
+
+async def test_oversize_party_rejected(rdb):
+    await create_queue(rdb, capacity=4, slots=1)
+    # Regular parties only fit the 3 seats that aren't reserved
+    assert (await join(rdb, "+12025550001", size=4))["error"] == "Party size exceeds block capacity"
+    assert await rdb.hlen(parties_key(CODE)) == 0
+
+@pytest.mark.parametrize("size", [0, -2])
+async def test_invalid_party_size_rejected(rdb, size):
+    await create_queue(rdb)
+    assert "error" in await join(rdb, "+12025550001", size=size)
+    assert await rdb.hlen(parties_key(CODE)) == 0
+    assert (await rdb.hgetall(status_key(CODE)))["size"] == "0"
+
+async def test_invalid_party_size_rejected_by_script(rdb):
+    await create_queue(rdb)
+    [(block_id, error)] = await place_parties(rdb, CODE, [("+12025550001", "1.5|0|Party", "1.5", 0)])
+    assert block_id is None and error
+
+@pytest.mark.parametrize("size", [0, -1])
+def test_party_info_rejects_invalid_size(size):
+    with pytest.raises(ValidationError):
+        PartyInfo(phone="+12025550001", name="Party", party_size=size)
+
+async def test_single_file_queue_opens_block_per_party(rdb):
+    await create_queue(rdb, capacity=-1)
+    placements = [await join(rdb, f"+1202555{i:04d}", size=50) for i in range(3)]
+    assert [p["block_id"] for p in placements] == [f"{CODE}-1", f"{CODE}-2", f"{CODE}-3"]
+
+async def test_removal_frees_seats(rdb):
+    await create_queue(rdb, capacity=4)
+    await join(rdb, "+12025550001", size=2)
+    await join(rdb, "+12025550002", size=2)
+    assert await remove_party(rdb, CODE, "+12025550001") == f"{CODE}-1"
+    assert (await block_state(rdb, 1))["used"] == "2"
+    assert (await join(rdb, "+12025550003", size=2))["block_id"] == f"{CODE}-1"
+    status = await rdb.hgetall(status_key(CODE))
+    assert (status["size"], status["parties"]) == ("4", "2")
+
+async def test_removal_of_absent_party(rdb):
+    await create_queue(rdb)
+    with pytest.raises(ResponseError, match="Party not in queue"):
+        await queue_manager.remove_party_from_block(rdb, CODE, "+12025550001")
+
+async def test_priority_parties_capped_per_block(rdb):
+    await create_queue(rdb, capacity=4, slots=2)
+    placements = [await join(rdb, f"+1202555{i:04d}", priority=1) for i in range(5)]
+    # Two reserved seats per block, so each block takes two priority parties and no more
+    assert [p["block_id"] for p in placements] == [f"{CODE}-1"] * 2 + [f"{CODE}-2"] * 2 + [f"{CODE}-3"]
+    for seq in (1, 2):
+        state = await block_state(rdb, seq)
+        assert (state["used"], state["reserved_used"]) == ("2", "2")
+    # The regular seats the priority parties left free are still there for everyone else
+    regular = [await join(rdb, f"+1202556{i:04d}") for i in range(2)]
+    assert [p["block_id"] for p in regular] == [f"{CODE}-1"] * 2
+
+async def test_priority_party_larger_than_slots_takes_regular_seats(rdb):
+    await create_queue(rdb, capacity=6, slots=2)
+    assert (await join(rdb, "+12025550001", size=3, priority=1))["block_id"] == f"{CODE}-1"
+    state = await block_state(rdb, 1)
+    assert (state["used"], state["reserved_used"]) == ("3", "0")
+    assert (await join(rdb, "+12025550002", size=5, priority=1))["error"] == "Party size exceeds block capacity"
+
+async def test_priority_leave_returns_reserved_seat(rdb):
+    await create_queue(rdb, capacity=4, slots=1)
+    await join(rdb, "+12025550001", priority=1)
+    await remove_party(rdb, CODE, "+12025550001")
+    assert (await block_state(rdb, 1))["reserved_used"] == "0"
+    assert (await join(rdb, "+12025550002", priority=1))["block_id"] == f"{CODE}-1"
+
+async def test_queue_without_slots_ignores_priority(rdb):
+    await create_queue(rdb, capacity=2)
+    placements = [await join(rdb, f"+1202555{i:04d}", priority=1) for i in range(3)]
+    assert [p["block_id"] for p in placements] == [f"{CODE}-1"] * 2 + [f"{CODE}-2"]
+
+def test_queue_info_rejects_bad_packing_settings():
+    with pytest.raises(ValidationError):
+        QueueInfo(lookahead_window=0)
+    with pytest.raises(ValidationError):
+        QueueInfo(packing_policy="random")
+
+async def test_stored_invalid_lookahead_window_falls_back(rdb):
+    from app.keys import packing_key
+    await create_queue(rdb, capacity=10, policy="lookahead")
+    await rdb.hset(packing_key(CODE), "window", -1)
+    placements = [await join(rdb, f"+1202555{i:04d}") for i in range(3)]
+    assert [p["block_id"] for p in placements] == [f"{CODE}-1"] * 3
+
+async def test_code_claim_expires_until_queue_is_initialized(rdb):
+    from app.keys import service_provider_key
+    code = await queue_manager.allocate_code(rdb, 1)
+    assert 0 < await rdb.ttl(service_provider_key(code)) <= queue_manager.CODE_CLAIM_SECONDS
+    await queue_manager.initialize_queue(rdb, QueueInfo(code=code, service_provider_id=1, name="Test"))
+    assert await rdb.ttl(service_provider_key(code)) == -1
@@ -0,0 +1,72 @@
+import pytest
+from fastapi import HTTPException
+from app import rate_limit
+from app.keys import rate_limit_key
+from benchmarks.scenarios import Bench
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+def limits(monkeypatch):
+    # The fixtures run with RATE_LIMIT_ENABLED=false, turn the buckets on for these tests only
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_ENABLED", True)
+    def set_limits(rule: str, **scopes: tuple):
+        monkeypatch.setitem(rate_limit.RATE_LIMITS, rule, scopes)
+    return set_limits
+
+async def allowed(rdb, rule: str, found: dict) -> bool:
+    try:
+        await rate_limit.enforce(rdb, rule, found)
+        return True
+    except HTTPException as e:
+        assert e.status_code == 429
+        return False
+
+async def test_burst_is_capped_at_capacity(rdb, limits):
+    limits("login", phone=(3, 300))
+    results = [await allowed(rdb, "login", {"phone": "+12025550001"}) for _ in range(5)]
+    assert results == [True, True, True, False, False]
+
+async def test_bucket_refills_over_time(rdb, limits):
+    limits("login", phone=(2, 60))
+    found = {"phone": "+12025550001"}
+    assert [await allowed(rdb, "login", found) for _ in range(3)] == [True, True, False]
+    # As if 30 seconds passed, which is one token at 2 per minute
+    key = rate_limit_key("login", "phone", found["phone"])
+    await rdb.hset(key, "at", float(await rdb.hget(key, "at")) - 30)
+    assert [await allowed(rdb, "login", found) for _ in range(2)] == [True, False]
+
+async def test_scopes_and_identities_have_separate_buckets(rdb, limits):
+    limits("join", caller=(1, 60), code=(2, 60))
+    assert await allowed(rdb, "join", {"caller": "+12025550001", "code": "AAAAAA"})
+    # Same code, another caller: only the code bucket is shared
+    assert await allowed(rdb, "join", {"caller": "+12025550002", "code": "AAAAAA"})
+    assert not await allowed(rdb, "join", {"caller": "+12025550003", "code": "AAAAAA"})
+    assert await allowed(rdb, "join", {"caller": "+12025550003", "code": "BBBBBB"})
+    assert sorted(await rdb.keys("ratelimit:*")) == sorted([
+        rate_limit_key("join", "caller", "+12025550001"), rate_limit_key("join", "caller", "+12025550002"),
+        rate_limit_key("join", "caller", "+12025550003"), rate_limit_key("join", "code", "AAAAAA"),
+        rate_limit_key("join", "code", "BBBBBB"),
+    ])
+
+async def test_rejection_takes_no_tokens(rdb, limits):
+    limits("join", caller=(1, 60), code=(5, 60))
+    assert await allowed(rdb, "join", {"caller": "+12025550001", "code": "AAAAAA"})
+    for _ in range(3):
+        assert not await allowed(rdb, "join", {"caller": "+12025550001", "code": "AAAAAA"})
+    # The code bucket only paid for the one request that went through
+    assert float(await rdb.hget(rate_limit_key("join", "code", "AAAAAA"), "tokens")) == pytest.approx(4, abs=0.01)
+
+async def test_login_gets_429_with_retry_after(target, limits):
+    limits("login", phone=(1, 120))
+    phone = Bench(target).next_phone()
+    assert (await target.client.post("/auth/login", json={"phone": phone, "name": "Party"})).status_code == 200
+    # The same phone typed differently shares the bucket
+    typed = f"({phone[2:5]}) {phone[5:8]}-{phone[8:]}"
+    response = await target.client.post("/auth/login", json={"phone": typed, "name": "Party"})
+    assert response.status_code == 429
+    assert 110 <= int(response.headers["Retry-After"]) <= 120
+
+def test_default_limits_do_not_key_on_address():
+    for rule in ("login", "verify", "provider_login", "join", "join_batch"):
+        assert "ip" not in rate_limit.RATE_LIMITS[rule]
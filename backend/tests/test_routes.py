@@ -0,0 +1,200 @@
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import queue_index
+from benchmarks.scenarios import Bench, register_provider, create_queue
+
+pytestmark = pytest.mark.anyio
+
+async def test_join_status_leave_round_trip(target):
+    bench = Bench(target)
+    code = await create_queue(bench, await register_provider(bench), 0)
+    phone = bench.next_phone()
+    headers = await bench.headers_for(phone)
+
+    # Clients may send the phone as typed, the party is stored under the normalized one
+    typed = f"({phone[2:5]}) {phone[5:8]}-{phone[8:]}"
+    body = (await target.client.post(f"/queue/join/{code}", headers=headers,
+                                     json={"phone": typed, "name": "Party", "party_size": 2})).json()
+    assert body["body"] == {"phone": phone, "block_id": f"{code}-1"}
+
+    status = (await target.client.get(f"/queue/status/{code}", headers=headers)).json()["body"]
+    assert (status["size"], status["parties"], status["party_block"]) == (2, 1, 1)
+
+    body = (await target.client.post(f"/queue/leave/{code}", headers=headers)).json()
+    assert body["body"] == {"phone": phone, "block_id": f"{code}-1"}
+    status = (await target.client.get(f"/queue/status/{code}", headers=headers)).json()["body"]
+    assert (status["size"], status["parties"], status["party_block"]) == (0, 0, None)
+
+async def test_join_for_another_phone_forbidden(target):
+    bench = Bench(target)
+    code = await create_queue(bench, await register_provider(bench), 0)
+    response = await target.client.post(f"/queue/join/{code}", headers=await bench.headers_for(bench.next_phone()),
+                                        json={"phone": bench.next_phone(), "name": "Party"})
+    assert response.status_code == 403
+
+async def test_join_rejects_invalid_party_size(target):
+    bench = Bench(target)
+    code = await create_queue(bench, await register_provider(bench), 0)
+    phone = bench.next_phone()
+    response = await target.client.post(f"/queue/join/{code}", headers=await bench.headers_for(phone),
+                                        json={"phone": phone, "name": "Party", "party_size": 0})
+    assert response.status_code == 422
+
+async def test_batch_join_normalizes_phones(target):
+    bench = Bench(target)
+    provider = await register_provider(bench)
+    code = await create_queue(bench, provider, 0)
+    phone = bench.next_phone()
+    typed = f"{phone[2:5]}-{phone[5:8]}-{phone[8:]}"
+    body = (await target.client.post(f"/queue/join/{code}/batch", headers=provider, json=[
+        {"phone": typed, "name": "Party"}, {"phone": "not a phone", "name": "Party"}, {"phone": phone, "name": "Party"},
+    ])).json()["body"]
+    assert (body["placed"], body["failed"]) == (1, 2)
+    assert body["results"] == [
+        {"phone": phone, "block_id": f"{code}-1"},
+        {"phone": "not a phone", "error": "Invalid phone number"},
+        {"phone": phone, "error": "Party already in queue"},
+    ]
+    # The party's own token finds the seat the provider took for it
+    status = (await target.client.get(f"/queue/status/{code}", headers=await bench.headers_for(phone))).json()["body"]
+    assert status["party_block"] == 1
+
+async def test_empty_provider_is_indexed_once(target, monkeypatch):
+    bench = Bench(target)
+    provider = await register_provider(bench)
+    builds = []
+    build_index = queue_index.build_index
+    async def counting_build_index(*args):
+        builds.append(args)
+        return await build_index(*args)
+    monkeypatch.setattr(queue_index, "build_index", counting_build_index)
+    for _ in range(3):
+        assert (await target.client.get("/queues", headers=provider)).json()["total"] == 0
+    assert len(builds) == 1
+    code = await create_queue(bench, provider, 0)
+    body = (await target.client.get("/queues", headers=provider)).json()
+    assert [queue["code"] for queue in body["body"]] == [code]
+
+async def test_deleted_queue_leaves_index(target):
+    bench = Bench(target)
+    provider = await register_provider(bench)
+    keep = await create_queue(bench, provider, 0, name="Kept")
+    code = await create_queue(bench, provider, 3, name="Deleted")
+    response = await target.client.request("DELETE", f"/queue/delete/{code}", headers=provider, json={})
+    assert response.status_code == 200
+    body = (await target.client.get("/queues", headers=provider)).json()
+    assert (body["total"], [queue["code"] for queue in body["body"]]) == (1, [keep])
+    assert await target.rdb.keys(f"queue:{{{code}}}*") == []
+
+async def test_failed_create_leaves_no_queue(target, monkeypatch):
+    bench = Bench(target)
+    provider = await register_provider(bench)
+    async def failing_commit(self):
+        raise RuntimeError("commit failed")
+    monkeypatch.setattr(AsyncSession, "commit", failing_commit)
+    with pytest.raises(RuntimeError):
+        await target.client.post("/queue/create", headers=provider, json={"name": "Lost", "max_block_capacity": 10})
+    monkeypatch.undo()
+    assert await target.rdb.keys("queue:{*") == []
+    assert (await target.client.get("/queues", headers=provider)).json()["total"] == 0
+
+@pytest.mark.parametrize("method, path", [("GET", "/queue/{code}"), ("POST", "/queue/dispatch/{code}")])
+async def test_queue_routes_authenticate_before_lookup(target, method, path):
+    bench = Bench(target)
+    code = await create_queue(bench, await register_provider(bench), 0)
+    # An existing and a missing code must look the same to a caller without a valid token
+    for headers in ({}, {"Authorization": "Bearer not-a-token"}):
+        statuses = {(await target.client.request(method, path.format(code=c), headers=headers)).status_code
+                    for c in (code, "ZZZZZ9")}
+        assert len(statuses) == 1 and statuses.pop() in (401, 403)
+
+async def make_legacy(target, codes: list[str]):
+    # Put the queues back in the untagged layout, with no provider index, as before either existed
+    import json
+    from app.keys import queue_key, service_provider_key, legacy_queue_key
+    rdb = target.rdb
+    for code in codes:
+        info = {field: json.loads(value) for field, value in (await rdb.hgetall(queue_key(code))).items()}
+        owner = await rdb.get(service_provider_key(code))
+        await rdb.delete(queue_key(code), service_provider_key(code))
+        await rdb.rpush(legacy_queue_key(code), json.dumps(info))
+        await rdb.set(f"{legacy_queue_key(code)}:service_provider_id", owner)
+    for key in await rdb.keys("provider:*"):
+        await rdb.delete(key)
+
+@pytest.mark.parametrize("bulk_migration", [False, True])
+async def test_legacy_provider_lists_untagged_queues(target, bulk_migration):
+    from app import migrations
+    bench = Bench(target)
+    provider = await register_provider(bench)
+    codes = sorted([await create_queue(bench, provider, 0, name=f"Legacy {n}") for n in range(2)])
+    await make_legacy(target, codes)
+    if bulk_migration:
+        # A marker left from a listing before the migration must not hide the moved queues
+        await target.rdb.set(queue_index.built_key(await target.rdb.get(f"queue:{codes[0]}:service_provider_id")), 1)
+        assert await migrations.migrate_all_queue_keys(target.rdb) == 2
+    for _ in range(2):
+        body = (await target.client.get("/queues", headers=provider)).json()
+        assert (body["total"], sorted(queue["code"] for queue in body["body"])) == (2, codes)
+
+async def test_self_join_cannot_claim_priority(target):
+    from app.keys import block_reserved_key
+    bench = Bench(target)
+    provider = await register_provider(bench)
+    code = (await target.client.post("/queue/create", headers=provider, json={
+        "name": "VIP", "max_block_capacity": 4, "max_priority_slots": 2})).json()["body"]["queue_code"]
+    phone = bench.next_phone()
+    await target.client.post(f"/queue/join/{code}", headers=await bench.headers_for(phone),
+                             json={"phone": phone, "name": "Party", "priority": 5})
+    vip = bench.next_phone()
+    await target.client.post(f"/queue/join/{code}/batch", headers=provider, json=[{"phone": vip, "name": "VIP", "priority": 1}])
+    assert await target.rdb.smembers(block_reserved_key(code, 1)) == {vip}
+
+async def test_rejected_join_is_client_error(target):
+    bench = Bench(target)
+    code = await create_queue(bench, await register_provider(bench), 0)
+    phone = bench.next_phone()
+    headers = await bench.headers_for(phone)
+    party = {"phone": phone, "name": "Party", "party_size": 11}
+    response = await target.client.post(f"/queue/join/{code}", headers=headers, json=party)
+    assert (response.status_code, response.json()["detail"]) == (400, "Party size exceeds block capacity")
+    await target.client.post(f"/queue/join/{code}", headers=headers, json={**party, "party_size": 1})
+    response = await target.client.post(f"/queue/join/{code}", headers=headers, json={**party, "party_size": 1})
+    assert (response.status_code, response.json()["detail"]) == (400, "Party already in queue")
+
+async def test_queue_listings_show_live_size_and_wait(target):
+    from app.keys import eta_key
+    bench = Bench(target)
+    provider = await register_provider(bench)
+    code = await create_queue(bench, provider, 25)
+    queue = (await target.client.get(f"/queue/{code}", headers=provider)).json()["body"]
+    assert queue["size"] == 25
+    await target.rdb.hset(eta_key(code), mapping={"interval": 600, "last_dispatch": 0})
+    queue = (await target.client.get(f"/queue/{code}", headers=provider)).json()["body"]
+    # Three blocks: the head is due now (last dispatch long ago), the last one two intervals later
+    assert queue["wait_time_estimate"] == "20 min"
+    [listed] = (await target.client.get("/queues", headers=provider)).json()["body"]
+    assert (listed["size"], listed["wait_time_estimate"]) == (25, "20 min")
+
+async def test_in_process_target_restores_the_app():
+    from app import db, event_log, main
+    from benchmarks import targets
+    originals = (event_log.read_new, main.create_redis, db.SessionLocal)
+    for _ in range(2):
+        async with targets.in_process():
+            assert event_log.read_new is not originals[0]
+        assert (event_log.read_new, main.create_redis, db.SessionLocal) == originals
+
+async def test_metrics_need_the_token_and_hide_queue_codes(target, monkeypatch):
+    from app import main, metrics
+    bench = Bench(target)
+    code = await create_queue(bench, await register_provider(bench), 3)
+    assert (await target.client.get("/metrics")).status_code == 404
+    monkeypatch.setattr(main, "METRICS_TOKEN", "scrape-token")
+    assert (await target.client.get("/metrics")).status_code == 401
+    headers = {"Authorization": "Bearer scrape-token"}
+    text = (await target.client.get("/metrics", headers=headers)).text
+    assert code not in text
+    assert "\nqueue_size 3.0\n" in text
+    monkeypatch.setattr(metrics, "METRICS_PER_QUEUE", True)
+    assert f'queue_size{{queue="{code}"}} 3.0' in (await target.client.get("/metrics", headers=headers)).text